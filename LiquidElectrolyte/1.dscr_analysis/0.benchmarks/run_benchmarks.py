@@ -0,0 +1,235 @@
+#!
+
+# ------------------------------------------------------------
+#
+# Descriptor throughput and memory benchmarks
+#
+# ------------------------------------------------------------
+
+import numpy as np
+import argparse
+import toml
+import os
+import sys
+import json
+import csv
+import copy
+import time
+import shutil
+import hashlib
+import platform
+import itertools
+import resource
+import subprocess
+import tempfile
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '../'))
+sys.path.append(os.path.join(HERE, '../../9.PIPELINE/'))
+sys.path.append(os.path.join(HERE, '../../../src/'))
+
+MODES = ['frame_by_frame', 'direct', 'chunk']
+
+# ------------------------------------------------------------
+# Functions
+# ------------------------------------------------------------
+
+# --- .toml file reader
+def get_config(filename):
+    with open(filename, 'r') as f:
+        if filename.endswith('.toml'):
+            _config = toml.load(f)
+        else:
+            raise NameError(f"Format of the '{filename}' is not supported. "
+                            "Available formats: .toml")
+        return SimpleNamespace(**_config)
+
+
+def case_key(case):
+    # identifies the same case across runs (regression check)
+    dscr = json.dumps(case['descriptor'], sort_keys=True)
+    return f"{case['mode']}|n{case['n_frame']}|c{case.get('chunk')}|{hashlib.sha1(dscr.encode()).hexdigest()[:8]}"
+
+
+def expand_cases(config):
+    """
+    One case per mode x n_frame x chunk x descriptor variant.
+    [[case]] tables: mode, n_frame = [..], chunk = [..] (chunk mode only),
+    grid = {descriptor key = [values]} on top of [descriptor]
+    """
+    cases = []
+    for table in config.case:
+        if table['mode'] not in MODES:
+            raise NameError('Unknown benchmark mode '+str(table['mode']))
+        grid = table.get('grid', {})
+        variants = []
+        for values in itertools.product(*grid.values()):
+            dscr = copy.deepcopy(config.descriptor)
+            dscr.update(dict(zip(grid.keys(), values)))
+            variants.append(dscr)
+        chunks = table.get('chunk', [None]) if table['mode'] == 'chunk' else [None]
+        for n_frame, chunk, dscr in itertools.product(table['n_frame'], chunks, variants):
+            case = dict(mode=table['mode'], n_frame=n_frame, chunk=chunk, descriptor=dscr,
+                        traj=os.path.join(config.system['dirpath'], config.system['name']))
+            case['key'] = case_key(case)
+            cases.append(case)
+    return cases
+
+
+# --- single case, run in its own process so that the peak RSS is its own
+def run_case(case):
+    from quippy import descriptors
+    import trajIO as tIO
+    import pipeDescriptor as pD
+
+    dscr_str = pD.get_soap_parameters(case['descriptor'])
+    source = tIO.open_traj(case['traj'])
+    n_frame = min(case['n_frame'], len(source))
+    t0 = time.time()
+    if case['mode'] == 'frame_by_frame':
+        import frame_by_frame_descriptor as fbf
+        ps = fbf.ds_frame_by_frame(case['traj'], descriptors.Descriptor(dscr_str), f_range=n_frame)
+    elif case['mode'] == 'direct':
+        frames = source.readFrames(0, n_frame)
+        ps = pD.SOAPdescriptor(case['descriptor']).DirectEval(frames)
+    elif case['mode'] == 'chunk':
+        store = tempfile.mkdtemp(prefix='bench_chunk_')
+        try:
+            ps = pD.SOAPdescriptor(case['descriptor']).ChunkEval(source, (0, n_frame, 1), case['chunk'],
+                                                                 store_name=store)
+            ps = np.array(ps)
+        finally:
+            shutil.rmtree(store, ignore_errors=True)
+    wall = time.time()-t0
+    natoms = int(source.natoms[0])
+    # ru_maxrss is in kB on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss/2**20 if sys.platform == 'darwin' else rss/2**10
+    return dict(key=case['key'], mode=case['mode'], n_frame=n_frame, chunk=case['chunk'],
+                natoms=natoms, dim=int(np.shape(ps)[-1]), wall=wall,
+                frames_per_s=n_frame/wall, atoms_per_s=n_frame*natoms/wall,
+                peak_rss_mb=rss_mb, descriptor=case['descriptor'])
+
+
+def spawn_case(case, timeout=None):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)],
+                          capture_output=True, text=True, timeout=timeout)
+    if proc.returncode != 0:
+        return dict(key=case['key'], mode=case['mode'], n_frame=case['n_frame'], chunk=case['chunk'],
+                    descriptor=case['descriptor'], error=proc.stderr.strip().splitlines()[-1:])
+    # result is the last stdout line, progress bars go to stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def write_results(results, meta, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'results.json'), 'w') as f:
+        json.dump(dict(meta=meta, results=results), f, indent=1)
+    cols = ['key', 'mode', 'n_frame', 'chunk', 'natoms', 'dim', 'wall',
+            'frames_per_s', 'atoms_per_s', 'peak_rss_mb', 'error']
+    with open(os.path.join(out_dir, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=cols, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def plot_results(results, out_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    ok = [r for r in results if 'error' not in r]
+    fig, axes = plt.subplots(1, 2, figsize=(10, 4), dpi=200)
+    series = sorted(set((r['mode'], r['chunk'], r['key'].split('|')[-1]) for r in ok), key=str)
+    for mode, chunk, dhash in series:
+        sel = sorted([r for r in ok if (r['mode'], r['chunk'], r['key'].split('|')[-1]) == (mode, chunk, dhash)],
+                     key=lambda r: r['n_frame'])
+        label = mode+(f' chunk={chunk}' if chunk else '')+' '+dhash
+        n = [r['n_frame'] for r in sel]
+        axes[0].plot(n, [r['frames_per_s'] for r in sel], 'o-', label=label)
+        axes[1].plot(n, [r['peak_rss_mb'] for r in sel], 'o-', label=label)
+    axes[0].set_xlabel('n_frame')
+    axes[0].set_ylabel('frames/s')
+    axes[1].set_xlabel('n_frame')
+    axes[1].set_ylabel('peak RSS (MB)')
+    axes[0].legend(fontsize=6)
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, 'benchmarks.png'))
+    plt.close(fig)
+
+
+def load_baseline(baseline_file):
+    with open(baseline_file, 'r') as f:
+        return {r['key']: r for r in json.load(f)['results'] if 'error' not in r}
+
+
+def compare(results, baseline, tol=0.2):
+    """
+    Cases slower (frames/s) or heavier (peak RSS) than the baseline by more than tol
+    :param baseline: {key: result} from load_baseline
+    """
+    regressions = []
+    for r in results:
+        b = baseline.get(r['key'])
+        if b is None:
+            continue
+        if 'error' in r:
+            regressions.append((r['key'], 'error', r['error']))
+            continue
+        if r['frames_per_s'] < (1-tol)*b['frames_per_s']:
+            regressions.append((r['key'], 'frames_per_s', b['frames_per_s'], r['frames_per_s']))
+        if r['peak_rss_mb'] > (1+tol)*b['peak_rss_mb']:
+            regressions.append((r['key'], 'peak_rss_mb', b['peak_rss_mb'], r['peak_rss_mb']))
+    return regressions
+
+# ------------------------------------------------------------
+# Main
+# ------------------------------------------------------------
+
+def main(config, baseline=None, tol=0.2):
+    run = getattr(config, 'run', {})
+    out_dir = os.path.join(HERE, run.get('out', 'results'))
+    cases = expand_cases(config)
+    # read before the run: the baseline may be the results.json about to be overwritten
+    baseline_results = load_baseline(baseline) if baseline is not None else None
+    meta = dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), host=platform.node(),
+                python=platform.python_version(), cpu_count=os.cpu_count(),
+                traj=os.path.join(config.system['dirpath'], config.system['name']))
+    results = []
+    for i, case in enumerate(cases):
+        print(f"({i+1}/{len(cases)}) {case['key']}")
+        for _ in range(run.get('repeat', 1)):
+            res = spawn_case(case, timeout=run.get('timeout'))
+            # best of the repeats
+            if not results or results[-1]['key'] != case['key']:
+                results.append(res)
+            elif 'error' not in res and res['frames_per_s'] > results[-1].get('frames_per_s', 0):
+                results[-1] = res
+        r = results[-1]
+        print(f"    {r['error']}" if 'error' in r else
+              f"    {r['frames_per_s']:.2f} frames/s  {r['atoms_per_s']:.0f} atoms/s  {r['peak_rss_mb']:.0f} MB")
+    write_results(results, meta, out_dir)
+    plot_results(results, out_dir)
+    if baseline is not None:
+        regressions = compare(results, baseline_results, tol)
+        for reg in regressions:
+            print('REGRESSION', *reg)
+        return len(regressions) == 0
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", dest="config", type=str,
+                        help="config file")
+    parser.add_argument("-b", dest="baseline", type=str, default=None,
+                        help="results.json of a previous run to check for regressions")
+    parser.add_argument("--tol", dest="tol", type=float, default=0.2,
+                        help="relative tolerance of the regression check")
+    parser.add_argument("--case", dest="case", type=str, default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case))))
+    else:
+        sys.exit(0 if main(get_config(args.config), args.baseline, args.tol) else 1)
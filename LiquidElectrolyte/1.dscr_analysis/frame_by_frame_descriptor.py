@@ -9,9 +9,14 @@
 import numpy as np
 import argparse
 import toml
-from ase.io import read, write
+import os
+import sys
 from quippy import descriptors
 from tqdm import tqdm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import trajIO as tIO
+from paramHash import param_hash
+import dscrStore as dS
 
 # ------------------------------------------------------------
 # Functions
@@ -44,8 +49,10 @@ def ds_frame_by_frame(sys_name, ds_obj,
     range_ = np.arange(1,f_range+1,every)
     if debug:
         print(len(range_), range_)
+    # binary cache or indexed text file: no re-scanning per frame
+    frames = tIO.open_traj(sys_name)
     for f in tqdm(range_, desc='Computing descriptor'):
-        snap_tmp = read(sys_name, index=str(f-1)+':'+str(f))
+        snap_tmp = [frames.readFrame(f-1)]
         ps_tmp = ds_obj.calc_descriptor(snap_tmp)
         # print(np.shape(ps_tmp))
         ps_list.append(ps_tmp)
@@ -91,10 +98,16 @@ def main(config):
                   '_n_Z'+\
                   str(config.descriptor['n_Z'])+\
                   '_Z'+config.descriptor['Z'][1:-1]+\
-                  '_Nframe'+str(n_frame)+'every'+str(skip)
+                  '_Nframe'+str(n_frame)+'every'+str(skip)+\
+                  '_'+param_hash(dscr_dict)[:8]
     
     if config.system['saveFile']:
-        np.save(config.system['outheader']+output_name, ds_vec)
+        # compact chunked store when [system] store_dtype is set (float32/float16)
+        if 'store_dtype' in config.system:
+            dS.save_descr(config.system['outheader']+output_name, ds_vec,
+                          dtype=config.system['store_dtype'])
+        else:
+            np.save(config.system['outheader']+output_name, ds_vec)
 
 
 if __name__ == "__main__":
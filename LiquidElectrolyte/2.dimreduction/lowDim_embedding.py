@@ -10,8 +10,12 @@ import numpy as np
 import numpy as np
 import argparse
 import toml
+import os
+import sys
 from sklearn.decomposition import PCA, KernelPCA
 from umap import UMAP
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import dscrStore as dS
 
 # ------------------------------------------------------------
 # Functions
@@ -88,8 +92,9 @@ def main(config):
     # - syst variable
     systname = config.system['dirpath'] + config.system['name']
     
-    # --- assumed to work with the .npy pyhton compressed format
-    X = np.load(systname)
+    # --- .npy or compact .dstore (float16 stores are read as float32),
+    # optional [system] dtype, e.g. 'float32', halves the RAM of float64 data
+    X = dS.load_descr(systname, dtype=config.system.get('dtype'))
     if len(X.shape) > 2:
         X = np.concatenate(X)
     
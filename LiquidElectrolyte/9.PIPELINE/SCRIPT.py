@@ -86,7 +86,9 @@ print(f"\n# --- Computing the descriptor ---\n")
 t0 = time.time()
 descrObj = pD.TURBOdescriptor(turbo_param_dict)
 print(f"Paramenters:\n{descrObj.dscr_str}")
+# chunks go into a single resumable store, the returned matrix is memory-mapped
 soap_descr = descrObj.ChunkEval(traj_read, frame_tuple=trajObj.readFrames, chunk=descr_dict['chunkEval'])
+t1 = time.time()
 print(f"{np.round(t1-t0, 1)}s")
 print(f"\nData matrix: {soap_descr.shape}")
 
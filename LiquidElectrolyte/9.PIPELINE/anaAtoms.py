@@ -3,9 +3,7 @@ from ase import Atoms
 import ase.geometry
 from scipy import sparse
 import numpy as np
-import extAtoms as ea
 import scipy.spatial
-from ase.ga.utilities import get_rdf
 import ase.data
 from tqdm import tqdm
 chem_syms = ase.data.chemical_symbols
@@ -33,28 +31,142 @@ def mol_chem_name(formula):
     else:
         raise NameError('Unknown formula "'+formula+'"')
 
+#neighbour search: pairs (i,j) with |pos[j]+shift@cell-pos[i]| < radii[i]+radii[j]+2*skin
+#(the ase NeighborList criterion, default ase skin is 0.3), returned as a CSR structure:
+#indices[indptr[i]:indptr[i+1]] are the neighbours of i, with dists and integer image shifts
+#backends: 'ase' (ase.neighborlist), 'cell' (linked-cell list), 'kdtree' (periodic cKDTree,
+#orthorhombic cells), 'auto' picks one from the system size and the cell
+NB_BACKENDS = ['ase', 'cell', 'kdtree']
+
+def neighbor_search(at, radii, skin=0.0, backend='auto', bothways=True):
+    N = len(at)
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), (N,))+skin
+    rmax = 2*np.max(radii) if N else 0.0
+    if backend == 'auto':
+        backend = _nb_auto_backend(at, rmax)
+    if backend == 'kdtree' and not _nb_kdtree_ok(at, rmax):
+        backend = 'cell'
+    if backend == 'cell' and not _nb_cell_ok(at, rmax):
+        backend = 'ase'
+    if backend == 'ase':
+        i, j, d, S = neighborlist.neighbor_list('ijdS', at, radii, self_interaction=False)
+    elif backend == 'cell':
+        i, j, d, S = _nb_cell(at, rmax)
+    elif backend == 'kdtree':
+        i, j, d, S = _nb_kdtree(at, rmax)
+    else:
+        raise NameError('Unknown neighbour backend '+str(backend))
+    keep = d < radii[i]+radii[j]
+    if not bothways:
+        #self images: keep the shift whose first non-zero component is positive
+        first = S[np.arange(len(S)), np.argmax(S != 0, axis=1)]
+        keep &= (i < j) | ((i == j) & (first > 0))
+    i, j, d, S = i[keep], j[keep], d[keep], S[keep]
+    order = np.lexsort((j, i))
+    return dict(indptr=np.r_[0, np.cumsum(np.bincount(i, minlength=N))],
+                indices=j[order], dists=d[order], shifts=S[order])
+
+#pair list (i, j) of a CSR neighbour structure
+def nb_pairs(nb):
+    i = np.repeat(np.arange(len(nb['indptr'])-1), np.diff(nb['indptr']))
+    return i, nb['indices']
+
+#sparse connectivity matrix of a CSR neighbour structure
+def nb_connectivity(nb):
+    N = len(nb['indptr'])-1
+    return sparse.csr_matrix((np.ones(len(nb['indices']), dtype=int), nb['indices'], nb['indptr']), shape=(N,N))
+
+def _nb_widths(cell):
+    #perpendicular widths of the cell
+    return cell.volume/np.linalg.norm(np.cross(cell[[1,2,0]], cell[[2,0,1]]), axis=1)
+
+def _nb_kdtree_ok(at, rmax):
+    cell = at.cell[:]
+    return all(at.pbc) and np.allclose(cell, np.diag(np.diag(cell))) and rmax < 0.5*np.min(np.diag(cell))
+
+def _nb_cell_ok(at, rmax):
+    return all(at.pbc) and rmax > 0 and np.all(np.floor(_nb_widths(at.cell)/rmax) >= 3)
+
+def _nb_auto_backend(at, rmax):
+    if len(at) < 500:
+        return 'ase'
+    if _nb_kdtree_ok(at, rmax):
+        return 'kdtree'
+    return 'cell'
+
+#wrapped positions and the integer shifts S0 such that pos = pos_w + S0@cell
+def _nb_wrap(at):
+    frac = at.cell.scaled_positions(at.positions)
+    S0 = np.floor(frac)
+    frac -= S0
+    frac[frac >= 1.0] = 0.0
+    return frac, S0.astype(int)
+
+def _nb_kdtree(at, rmax):
+    L = np.diag(at.cell[:])
+    frac, S0 = _nb_wrap(at)
+    pw = frac*L
+    tree = scipy.spatial.cKDTree(pw, boxsize=L)
+    pairs = tree.query_pairs(rmax, output_type='ndarray')
+    i = np.concatenate([pairs[:,0], pairs[:,1]])
+    j = np.concatenate([pairs[:,1], pairs[:,0]])
+    vec = pw[j]-pw[i]
+    img = -np.round(vec/L).astype(int)
+    vec += img*L
+    return i, j, np.linalg.norm(vec, axis=1), img+S0[i]-S0[j]
+
+#linked cells: at most ~1 atom per cell (memory O(N) whatever rmax), the neighbouring
+#cells are scanned as far as rmax reaches along each axis
+def _nb_cell(at, rmax):
+    cell = at.cell[:]
+    widths = _nb_widths(at.cell)
+    nc = np.minimum(np.floor(widths/rmax), max(1, round(len(at)**(1/3)))).astype(int)
+    nc = np.maximum(nc, 1)
+    reach = np.ceil(rmax*nc/widths).astype(int)
+    frac, S0 = _nb_wrap(at)
+    pw = frac@cell
+    cidx = np.minimum(np.floor(frac*nc).astype(int), nc-1)
+    cid = np.ravel_multi_index(cidx.T, nc)
+    order = np.argsort(cid, kind='stable')
+    counts = np.bincount(cid, minlength=np.prod(nc))
+    start = np.cumsum(counts)-counts
+    I, J, D, SS = [], [], [], []
+    rng = [np.arange(-k, k+1) for k in reach]
+    for off in np.array(np.meshgrid(*rng, indexing='ij')).reshape(3,-1).T:
+        nb = cidx+off
+        img = np.floor_divide(nb, nc)
+        ncid = np.ravel_multi_index((nb-img*nc).T, nc)
+        cnt = counts[ncid]
+        i = np.repeat(np.arange(len(at)), cnt)
+        j = order[np.repeat(start[ncid], cnt)+np.arange(cnt.sum())-np.repeat(np.cumsum(cnt)-cnt, cnt)]
+        shift = img[i]
+        vec = pw[j]+shift@cell-pw[i]
+        d = np.linalg.norm(vec, axis=1)
+        keep = (d < rmax) & ((i != j) | np.any(shift != 0, axis=1))
+        I.append(i[keep]); J.append(j[keep]); D.append(d[keep])
+        SS.append(shift[keep]+S0[i[keep]]-S0[j[keep]])
+    return np.concatenate(I), np.concatenate(J), np.concatenate(D), np.concatenate(SS)
+
 #computes molID for single config, not adding molID to atoms.arrays
-def find_molec(at, fct=1.0):
-    #from https://wiki.fysik.dtu.dk/ase/ase/neighborlist.html
+def find_molec(at, fct=1.0, backend='auto'):
     cutOff = modif_natural_cutoffs(at, fct)
-    nbLst = neighborlist.NeighborList(cutOff, self_interaction=False, bothways=True)
-    nbLst.update(at)
-    conMat = nbLst.get_connectivity_matrix(sparse=True)
+    conMat = nb_connectivity(neighbor_search(at, cutOff, skin=0.3, backend=backend))
     Nmol, molID = sparse.csgraph.connected_components(conMat)
     Natoms, Nmols = np.unique(np.unique(molID, return_counts=True)[1], return_counts=True)
     return list(zip(Nmols,Natoms))
 
-#computes molIDs
-def find_molecs(db, fct=1.0, return_mask=False):
+#computes molIDs, from the fixed topology if given
+def find_molecs(db, fct=1.0, return_mask=False, topo=None, backend='auto'):
     masks = []
     for at in db:
-        #from https://wiki.fysik.dtu.dk/ase/ase/neighborlist.html
-        cutOff = modif_natural_cutoffs(at, fct)
-        nbLst = neighborlist.NeighborList(cutOff, self_interaction=False, bothways=True)
-        nbLst.update(at)
-        conMat = nbLst.get_connectivity_matrix(sparse=True)
-        Nmol, molID = sparse.csgraph.connected_components(conMat)
-        at.arrays['molID'] = molID
+        if topo is not None:
+            topo.assign(at)
+        else:
+            cutOff = modif_natural_cutoffs(at, fct)
+            conMat = nb_connectivity(neighbor_search(at, cutOff, skin=0.3, backend=backend))
+            Nmol, molID = sparse.csgraph.connected_components(conMat)
+            at.arrays['molID'] = molID
+        molID = at.arrays['molID']
         if return_mask:
             mask = np.zeros([len(molID)]*2)
             for mID in np.unique(molID):
@@ -63,23 +175,86 @@ def find_molecs(db, fct=1.0, return_mask=False):
     if return_mask:
         return masks
 
+#molecular topology of a non-reactive system, computed once from a reference frame:
+#molID, bond list, molecule types and per-molecule atom indices (order[starts[m]:starts[m+1]])
+#frames are validated by checking the reference bond lengths only
+class MolTopology:
+    def __init__(self, at, fct=1.0, skin=0.3, backend='auto'):
+        self.fct = fct
+        self.cutOff = np.array(modif_natural_cutoffs(at, fct))
+        nb = neighbor_search(at, self.cutOff, skin=skin, backend=backend, bothways=False)
+        conMat = nb_connectivity(nb)
+        self.Nmol, self.molID = sparse.csgraph.connected_components(conMat)
+        self.bonds = np.unique(np.array(nb_pairs(nb)).T, axis=0).reshape(-1,2)
+        #same criterion as the neighbour list
+        self.bondCut = self.cutOff[self.bonds[:,0]]+self.cutOff[self.bonds[:,1]]+2*skin
+        self.order = np.argsort(self.molID, kind='stable')
+        self.starts = np.r_[0, np.cumsum(np.bincount(self.molID))]
+        self.masses = at.get_masses()
+        self.numbers = at.numbers.copy()
+        self.molSym = mol_types(at, self.molID)
+        #bfs spanning tree of each molecule grouped by depth, for vectorized wrapping
+        conSym = conMat + conMat.T
+        depth = np.zeros(len(at), dtype=int)
+        parent = np.full(len(at), -1)
+        for m in range(self.Nmol):
+            nodes, preds = sparse.csgraph.breadth_first_order(conSym, self.order[self.starts[m]], directed=False)
+            for n in nodes[1:]:
+                parent[n] = preds[n]
+                depth[n] = depth[preds[n]]+1
+        self.treeLevels = [(parent[depth==d], np.flatnonzero(depth==d)) for d in range(1, depth.max()+1)]
+
+    def molecule(self, m):
+        return self.order[self.starts[m]:self.starts[m+1]]
+
+    def bond_lengths(self, at):
+        vecs = at.positions[self.bonds[:,1]]-at.positions[self.bonds[:,0]]
+        return ase.geometry.find_mic(vecs, at.cell, at.pbc)[1]
+
+    def check(self, at):
+        return len(at)==len(self.molID) and np.all(self.bond_lengths(at) < self.bondCut)
+
+    #completes molecules over pbc (unless full) and shifts their COM back to the unit cell
+    #same as wrap_molec over all molecules, returns the wrapped COMs [Nmol,3]
+    def wrap(self, at, full=False):
+        pos = at.positions
+        if not full:
+            for parents, children in self.treeLevels:
+                vecs = ase.geometry.find_mic(pos[children]-pos[parents], at.cell, at.pbc)[0]
+                pos[children] = pos[parents]+vecs
+        cm = mol_com(pos, self.molID, self.masses)
+        wrap_cm = ase.geometry.wrap_positions(positions=cm, cell=at.cell, pbc=at.pbc)
+        pos += (wrap_cm-cm)[self.molID]
+        at.positions = pos
+        return wrap_cm
+
+    #validates the frame and sets its molID
+    def assign(self, at):
+        if not self.check(at):
+            raise ValueError('Frame does not match the reference topology (broken bond or different atoms)')
+        at.arrays['molID'] = self.molID.copy()
+
 #computes number of neighbours
-def find_num_nb(db, Rcut=6.0):
+def find_num_nb(db, Rcut=6.0, backend='auto'):
     NumNbs = []
     for at in db:
-        nbLst = neighborlist.NeighborList([Rcut/2.0]*len(at), self_interaction=False, bothways=True)
-        nbLst.update(at)
-        conMat = nbLst.get_connectivity_matrix(sparse=False)
-        NumNbs += list(np.sum(conMat, axis=0))
+        nb = neighbor_search(at, Rcut/2.0, skin=0.3, backend=backend)
+        NumNbs += list(np.diff(nb['indptr']))
     return np.array(NumNbs)
 
 #extracts molecules CM into a new trajectory without changing any coordinates
 #designed mainly for extracting diffusion coefficients, assumes no wrapping
 #assumes molIDs exist and molecules are full
 #this is a bit redundant with wrap_molecs, maybe could be combined in the future
-def extract_molecs(db, fct=1):
+def extract_molecs(db, fct=1, topo=None):
     moldb = []
     for at in db:
+        if topo is not None:
+            topo.assign(at)
+            newmol = Atoms(positions=mol_com(at.positions, topo.molID, topo.masses), pbc=True, cell=at.cell)
+            newmol.arrays['molSym'] = topo.molSym.copy()
+            moldb.append(newmol)
+            continue
         if 'molID' not in at.arrays.keys():
             find_molecs([at], fct=fct)
         molID = at.arrays['molID']
@@ -96,40 +271,73 @@ def extract_molecs(db, fct=1):
         moldb.append(newmol)
     return moldb
 
+#maps molecule types once, from a single frame and its molID (np.unique order)
+def mol_types(at, molID):
+    order = np.argsort(molID, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(molID[order]) != 0])
+    syms = np.array(at.get_chemical_symbols())[order]
+    return np.array([mol_chem_name(Atoms(list(s)).get_chemical_formula()) for s in np.split(syms, starts[1:])])
+
+#COMs of all molecules for a batch of frames as one segmented reduction
+#positions [Nframe,Nat,3] (or [Nat,3]) -> [Nframe,Nmol,3] (or [Nmol,3]), molecules in np.unique(molID) order
+#assumes no wrapping, as extract_molecs
+def mol_com(positions, molID, masses):
+    order = np.argsort(molID, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(molID[order]) != 0])
+    w = masses[order]
+    wpos = np.take(positions, order, axis=-2)*w.reshape(-1,1)
+    return np.add.reduceat(wpos, starts, axis=-2)/np.add.reduceat(w, starts).reshape(-1,1)
+
+#COM trajectory as compact arrays: com [Nframe,Nmol,3], cells [Nframe,3,3], molSym [Nmol]
+#db can be any iterable of frames (e.g. a stream), reduced batch by batch
+def extract_molecs_com(db, molID, masses=None, molSym=None, batch=1000):
+    com = []
+    cells = []
+    buf = []
+    for at in tqdm(db, desc='Computing Mol COM'):
+        if masses is None:
+            masses = at.get_masses()
+        if molSym is None:
+            molSym = mol_types(at, molID)
+        buf.append(at.positions)
+        cells.append(at.cell[:])
+        if len(buf) == batch:
+            com.append(mol_com(np.array(buf), molID, masses))
+            buf = []
+    if buf:
+        com.append(mol_com(np.array(buf), molID, masses))
+    return np.concatenate(com), np.array(cells), molSym
+
 # new
 def extract_molecs_molID(db, molID, fct=1):
+    com, cells, molSym = extract_molecs_com(db, molID)
     moldb = []
-    for at in tqdm(db, desc='Computing Mol COM'):
-        molCM = []
-        molSym = []
-        for m in np.unique(molID):
-            mol = at[molID==m] #copy by value
-            mass = mol.get_masses()
-            cm = np.sum(mol.positions*mass.reshape(-1,1), axis=0)/np.sum(mass)
-            molCM.append(cm)
-            molSym.append(mol_chem_name(mol.symbols.get_chemical_formula()))
-        newmol = Atoms(positions=np.array(molCM), pbc=True, cell=at.cell)
-        newmol.arrays['molSym'] = np.array(molSym)
+    for cm, cell in zip(com, cells):
+        newmol = Atoms(positions=cm, pbc=True, cell=cell)
+        newmol.arrays['molSym'] = molSym.copy()
         moldb.append(newmol)
     return moldb
 
 
 #wraps single molecule: completes molecule over pbc and sfits COM back to unit cell
-def wrap_molec(mol, fct=1.0, full=False):
+def wrap_molec(mol, fct=1.0, full=False, backend='auto'):
     if not full:
         cutOff = modif_natural_cutoffs(mol, fct)
-        nbLst = neighborlist.NeighborList(cutOff, self_interaction=False, bothways=True)
+        nb = neighbor_search(mol, cutOff, skin=0.3, backend=backend)
+        #image of each atom placing it next to the atom it was reached from
+        img = np.zeros((len(mol),3), dtype=int)
         visited = []
         tovisit = [0]
         while tovisit:
             i = tovisit.pop(0)
-            nbLst.update(mol)
-            nbs, vecs = nbLst.get_neighbors(i)
+            nbs = nb['indices'][nb['indptr'][i]:nb['indptr'][i+1]]
+            vecs = nb['shifts'][nb['indptr'][i]:nb['indptr'][i+1]]
             for j, v in zip(nbs, vecs):
                 if (j not in visited) and (j not in tovisit):
-                    mol.positions[j,:] += np.dot(v, mol.cell)
+                    img[j] = img[i]+v
                     tovisit.append(j)
             visited.append(i)
+        mol.positions += np.dot(img, mol.cell)
     m = mol.get_masses()
     cm = np.sum(mol.positions*m.reshape(-1,1), axis=0)/np.sum(m)
     wrap_cm = ase.geometry.wrap_positions(positions=[cm], cell=mol.cell, pbc=mol.pbc)[0]
@@ -137,21 +345,27 @@ def wrap_molec(mol, fct=1.0, full=False):
     return wrap_cm
 
 #wraps all molecules over a list of configurations
-def wrap_molecs(db, fct=1.0, full=False, prog=False, returnMols=False):
+def wrap_molecs(db, fct=1.0, full=False, prog=False, returnMols=False, topo=None, backend='auto'):
     moldb = []
     iter = 0
     for at in db:
         if prog:
             iter += 1
             print(iter)
+        if topo is not None:
+            topo.assign(at)
+            newmol = Atoms(positions=topo.wrap(at, full), pbc=True, cell=at.cell)
+            newmol.arrays['molSym'] = topo.molSym.copy()
+            moldb.append(newmol)
+            continue
         if 'molID' not in at.arrays.keys():
-            find_molecs([at], fct)
+            find_molecs([at], fct, backend=backend)
         molID = at.arrays['molID']
         molCM = []
         molSym = []
         for m in np.unique(molID):
             mol = at[molID==m] #copy by value
-            cm = wrap_molec(mol, fct, full)
+            cm = wrap_molec(mol, fct, full, backend)
             #at[molID==m].positions = mol.positions #does not work at[molID==m] is not a ref
             at.positions[molID==m,:] = mol.positions
             molCM.append(cm)
@@ -174,25 +388,48 @@ def split_molecs(db, scale=1.0):
     return smdb
 
 #collects intra- and inter- molecular contributions
+#smdb grouped by uid once (stable, assumes molecules are in the original condensed phase order),
+#per-molecule energies, virials and the flat force buffer gathered with offset arrays
 def collect_molec_results(db, smdb, fext='', dryrun=False):
+    uids, code = np.unique([at.info['uid'] for at in smdb], return_inverse=True)
+    order = np.argsort(code, kind='stable')
+    molptr = np.r_[0, np.cumsum(np.bincount(code, minlength=len(uids)))]
+    #atoms of the molecules in grouped order: gather index into the concatenated smdb arrays
+    nat = np.array([len(at) for at in smdb])
+    atptr = np.r_[0, np.cumsum(nat)]
+    grpptr = np.r_[0, np.cumsum(nat[order])]
+    gather = np.repeat(atptr[order]-grpptr[:-1], nat[order])+np.arange(grpptr[-1])
+    atgrp = grpptr[molptr]
+    if dryrun:
+        pos = np.concatenate([at.positions for at in smdb])[gather]
+    else:
+        E = np.array([at.info['energy'+fext] for at in smdb])[order]
+        V = np.array([at.info['virial'+fext] for at in smdb])[order]
+        F = np.concatenate([at.arrays['forces'+fext] for at in smdb]).astype(float)[gather]
+    lut = {uid: k for k, uid in enumerate(uids)}
     for at in db:
-        sel = ea.sel_by_uid(smdb, at.info['uid']) #assumes molecules are in the original condensed phase order
+        k = lut.get(at.info['uid'])
+        if k is None:
+            #no molecules found, as an empty selection
+            mols, atoms = slice(0, 0), slice(0, 0)
+        else:
+            mols, atoms = slice(molptr[k], molptr[k+1]), slice(atgrp[k], atgrp[k+1])
         if dryrun:
-            print(np.sum(np.abs(at.positions - np.concatenate(ea.get_prop(sel,'arrays','positions'))))) #check if that was true
+            print(np.sum(np.abs(at.positions - pos[atoms]))) #check if that was true
         else:
-            at.info['energy'+fext+'_intram_mol'] = ea.get_prop(sel, 'info', 'energy'+fext)
-            at.info['energy'+fext+'_intram'] = sum(ea.get_prop(sel, 'info', 'energy'+fext))
-            at.info['virial'+fext+'_intram'] = sum(ea.get_prop(sel, 'info', 'virial'+fext))
-            at.arrays['forces'+fext+'_intram'] = np.concatenate(ea.get_prop(sel, 'arrays', 'forces'+fext)).astype(float)
+            at.info['energy'+fext+'_intram_mol'] = E[mols]
+            at.info['energy'+fext+'_intram'] = sum(E[mols])
+            at.info['virial'+fext+'_intram'] = sum(V[mols])
+            at.arrays['forces'+fext+'_intram'] = F[atoms]
             at.info['energy'+fext+'_interm'] = at.info['energy'+fext]-at.info['energy'+fext+'_intram']
             at.info['virial'+fext+'_interm'] = at.info['virial'+fext]-at.info['virial'+fext+'_intram']
             at.arrays['forces'+fext+'_interm'] = at.arrays['forces'+fext]-at.arrays['forces'+fext+'_intram']
 
 #starting from one configuration, adjusts the volume according to vol_fracs
-def scan_vol(at, vol_fracs, frozen=True):
+def scan_vol(at, vol_fracs, frozen=True, topo=None):
     db = []
     lat_fracs = vol_fracs**(1.0/3.0)
-    mol = wrap_molecs([at], fct=1, full=False, prog=False, returnMols=True)[0]
+    mol = wrap_molecs([at], fct=1, full=False, prog=False, returnMols=True, topo=topo)[0]
     molID = at.arrays['molID']
     for f in lat_fracs:
         mol_disps = mol.positions*(f-1)
@@ -208,120 +445,210 @@ def scan_vol(at, vol_fracs, frozen=True):
         db.append(nat)
     return db
 
-#find voids: copied from https://github.com/gabor1/workflow/blob/main/wfl/utils/find_voids.py
-def find_voids(at):
-    transl_symprec = 1.0e-1
-    # save original cell
-    cell_orig = at.get_cell()
-    reciprocal_cell_orig = at.get_reciprocal_cell()
-    # create supercell
-    at_sc = at * [3, 3, 3]
-    at_sc.set_positions(at_sc.get_positions() - np.sum(cell_orig, axis=0))
-    # calculate Voronoi tesselation
-    vor = scipy.spatial.Voronoi(at_sc.get_positions())
-    # list possible centers from Voronoi vertices that are close to original cell
-    possible_centers_lat = np.matmul(vor.vertices, reciprocal_cell_orig.T)
-    possible_indices = np.where(np.all(np.abs(possible_centers_lat - 0.5) <= 0.6, axis=1))[0]
-    # create atoms object with supercell of all possible interstitial positions
-    vertices = vor.vertices[possible_indices]
+#atom images within `width` of the cell (ghost layer): wrapped positions, cell images and atom indices
+def _ghost_layer(at, width):
+    frac, _ = _nb_wrap(at)
+    pad = width/_nb_widths(at.cell)
+    rng = [np.arange(-int(np.ceil(p)), int(np.ceil(p))+1) for p in pad]
+    imgs = np.array(np.meshgrid(*rng, indexing='ij')).reshape(3,-1).T
+    imgs = imgs[np.argsort(np.abs(imgs).sum(axis=1), kind='stable')]
+    pos = []
+    ids = []
+    for img in imgs:
+        f = frac+img
+        keep = np.all((f >= -pad) & (f < 1+pad), axis=1)
+        pos.append(at.cell.cartesian_positions(f[keep]))
+        ids.append(np.flatnonzero(keep))
+    return np.concatenate(pos), np.concatenate(ids)
+
+#void centres (Voronoi vertices, one per periodic image) and radii (distance to the nearest atom)
+#Voronoi of the cell plus a ghost layer of `width` (default: two mean atomic radii), widened until
+#it is thicker than the largest void; candidates within `margin` (fractional) of the cell are wrapped,
+#duplicates within transl_symprec (A) removed with a periodic neighbour search
+def void_sites(at, width=None, margin=1.0e-1, transl_symprec=1.0e-1, backend='auto'):
+    if width is None:
+        width = 2*(3*at.get_volume()/len(at)/4/np.pi)**(1/3)
+    while True:
+        pos, _ = _ghost_layer(at, width)
+        vor = scipy.spatial.Voronoi(pos)
+        frac = at.cell.scaled_positions(vor.vertices)
+        inside = np.all((frac >= -margin) & (frac < 1+margin), axis=1)
+        centres = at.cell.cartesian_positions(frac[inside] % 1.0)
+        radii, _ = scipy.spatial.cKDTree(pos).query(centres)
+        if len(radii) == 0 or np.max(radii) < width:
+            break
+        width = 1.5*np.max(radii)
+    #as the original: a site is dropped if any atom or earlier site lies within transl_symprec
+    Na = len(at)
+    at_w = Atoms(positions=np.concatenate([at.positions, centres]), cell=at.cell, pbc=True)
+    i, j = nb_pairs(neighbor_search(at_w, transl_symprec/2, backend=backend, bothways=False))
+    drop = np.zeros(len(at_w), dtype=bool)
+    drop[np.maximum(i, j)] = True
+    keep = ~drop[Na:]
+    return centres[keep], radii[keep]
+
+#find voids: same output as https://github.com/gabor1/workflow/blob/main/wfl/utils/find_voids.py
+#(the structure plus one X atom per void), without the 3x3x3 supercell Voronoi
+def find_voids(at, transl_symprec=1.0e-1):
+    centres, _ = void_sites(at, transl_symprec=transl_symprec)
     at_w_interst = at.copy()
-    at_w_interst.extend(Atoms('X{}'.format(len(possible_indices)), positions=vertices))
-    # eliminate duplicates that are equivalent by translation
-    dists = at_w_interst.get_all_distances(mic=True)
-    del_list = set()
-    for i in range(len(at_w_interst) - 1):
-        dups = i + 1 + np.where(dists[i][i + 1:] < transl_symprec)[0]
-        del_list = del_list.union(set(dups))
-    del at_w_interst[list(del_list)]
+    at_w_interst.extend(Atoms('X{}'.format(len(centres)), positions=centres))
     return at_w_interst
 
+#void centres and radii of every frame, voids smaller than rmin are dropped
+def find_voids_traj(db, rmin=0.0, transl_symprec=1.0e-1, backend='auto'):
+    centres = []
+    radii = []
+    for at in tqdm(db, desc='Finding voids'):
+        c, r = void_sites(at, transl_symprec=transl_symprec, backend=backend)
+        centres.append(c[r >= rmin])
+        radii.append(r[r >= rmin])
+    return centres, radii
+
+#grid void detection: grid of spacing ~dx in fractional coordinates (triclinic cells too),
+#nearest-atom distance of every grid point from a KD-tree over the cell plus a ghost layer;
+#void points are further than xminfct*xmin from all atoms, xmin the mean atomic radius
+#returns dict(dist [N0,N1,N2], mask [N0,N1,N2], grid [N0,N1,N2,3] frac, free=void fraction, rcut)
+def void_grid(at, dx=2.0, xminfct=2.0):
+    N = [max(int(x), 1) for x in at.cell.lengths()/dx]
+    frac = np.stack(np.meshgrid(*[np.arange(n)/n for n in N], indexing='ij'), axis=-1)
+    grid = at.cell.cartesian_positions(frac.reshape(-1,3))
+    xmin = (3*at.get_volume()/at.get_global_number_of_atoms()/4/np.pi)**(1/3)
+    rcut = xmin*xminfct
+    width = 2*rcut
+    while True:
+        pos, _ = _ghost_layer(at, width)
+        dist, _ = scipy.spatial.cKDTree(pos).query(grid, distance_upper_bound=width)
+        if np.all(np.isfinite(dist)):
+            break
+        width *= 2
+    dist = dist.reshape(N)
+    mask = dist > rcut
+    return dict(dist=dist, mask=mask, grid=frac, free=np.mean(mask), rcut=rcut)
+
+#structures with an X atom at every void grid point and the number of void points per frame
 def find_voids_grid(db, dx=2.0, xminfct=2.0, prog=False):
     db_grid = []
-    iter = 0
     pts = []
-    for at in db:
-        if prog:
-            iter += 1
-            print(iter)
-        mat = at.cell
-        N = [int(x) for x in (np.diag(at.cell)/dx)]
-        Na = len(at)
-        x = np.arange(0, 1, 1/N[0])
-        y = np.arange(0, 1, 1/N[1])
-        z = np.arange(0, 1, 1/N[2])
-        X, Y, Z = np.meshgrid(x, y, z)
-        grid = np.dot(np.array([X,Y,Z]).reshape(3,-1).T, at.cell)
+    for at in tqdm(db, desc='Finding voids', disable=not prog):
+        vg = void_grid(at, dx, xminfct)
+        voids = at.cell.cartesian_positions(vg['grid'][vg['mask']])
         at_wgrid = at.copy()
-        at_wgrid.extend(Atoms('X{}'.format(len(grid)), positions=grid))
-        dst = at_wgrid.get_all_distances(mic=True)
-        dst = dst[Na:,:Na]
-        xmin = (3*at.get_volume()/at.get_global_number_of_atoms()/4/np.pi)**(1/3)
-        ids = np.where(np.any(dst<=xmin*xminfct, axis=1))[0]
-        ids += Na
-        del at_wgrid[list(ids)]
+        at_wgrid.extend(Atoms('X{}'.format(len(voids)), positions=voids))
         db_grid.append(at_wgrid)
-        pts.append(len(grid)-len(ids))
+        pts.append(len(voids))
     return db_grid, pts
 
-def track_initial_bonds(db, fct=1, prog=False):
-    cutOff = modif_natural_cutoffs(db[0], fct)
-    nbLst = neighborlist.NeighborList(cutOff, self_interaction=False, bothways=False)
-    nbLst.update(db[0])
-    conMat = nbLst.get_connectivity_matrix(sparse=False)
-    dists = db[0].get_all_distances(mic=True)[conMat==True].reshape(-1,1)
-    iter = 0
-    for at in db[1:]:
-        if prog:
-            iter += 1
-            print(iter)
-        dists = np.hstack([dists, at.get_all_distances(mic=True)[conMat==True].reshape(-1,1)])
+#streams void_grid over a trajectory with constant memory: free volume fraction per frame and
+#the pore-size histogram (nearest-atom distance of the void points) accumulated over all frames
+def void_grid_traj(db, dx=2.0, xminfct=2.0, bins=np.linspace(0, 10, 101), keep_masks=False):
+    free = []
+    masks = []
+    hist = np.zeros(len(bins)-1, dtype=int)
+    for at in tqdm(db, desc='Finding voids'):
+        vg = void_grid(at, dx, xminfct)
+        free.append(vg['free'])
+        hist += np.histogram(vg['dist'][vg['mask']], bins=bins)[0]
+        if keep_masks:
+            masks.append(vg['mask'])
+    res = dict(free=np.array(free), hist=hist, bins=bins)
+    if keep_masks:
+        res['masks'] = masks
+    return res
+
+#bond lengths [Nbonds, Nframes] of the bonds found in the first frame (or in topo), mic distances of
+#the bonded pairs only, written into a preallocated array, or a .npy memmap when out is a file name
+#db can be a stream (e.g. FrameIndex.iterFrames, TrajLoader.iterTraj): Nframes then from nframes
+#rows follow the bonds sorted by (i, j) with i < j (topo.bonds order with topo), not the ase
+#half-list order of the older versions: return_bonds=True returns (bonds [Nbonds,2], dists)
+def track_initial_bonds(db, fct=1, prog=False, topo=None, backend='auto', nframes=None, out=None,
+                        return_bonds=False):
+    if nframes is None:
+        if not hasattr(db, '__len__'):
+            db = list(db)
+        nframes = len(db)
+    frames = iter(db)
+    at = next(frames)
+    if topo is not None:
+        bonds = topo.bonds
+    else:
+        cutOff = modif_natural_cutoffs(at, fct)
+        nb = neighbor_search(at, cutOff, skin=0.3, backend=backend, bothways=False)
+        bonds = np.unique(np.array(nb_pairs(nb)).T, axis=0).reshape(-1,2)
+    if out is None:
+        dists = np.empty((len(bonds), nframes))
+    else:
+        dists = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=(len(bonds), nframes))
+    for f in tqdm(range(nframes), desc='Tracking bonds', disable=not prog):
+        if f > 0:
+            at = next(frames)
+        vecs = at.positions[bonds[:,1]]-at.positions[bonds[:,0]]
+        dists[:,f] = ase.geometry.find_mic(vecs, at.cell, at.pbc)[1]
+    if out is not None:
+        dists.flush()
+    if return_bonds:
+        return bonds, dists
     return dists
 
-def track_distrib_grid(db, N=2, prog=False):
+#grid cell index of every atom, N cells per axis (int or per-axis triplet), cell (i,j,k) -> (i*N1+j)*N2+k
+def grid_index(at, N):
+    N = np.broadcast_to(np.asarray(N, dtype=int), (3,))
+    frac = at.get_scaled_positions(wrap=True)
+    ijk = np.minimum(np.floor(frac*N).astype(int), N-1)
+    return (ijk[:,0]*N[1]+ijk[:,1])*N[2]+ijk[:,2], int(np.prod(N))
+
+#masses, numbers of atoms and densities (g/cm^3) of every grid cell over a trajectory (or stream):
+#one bincount per frame, [Nframe, Ncell] results; masses and numbers normalised by their frame mean
+#species: list of chemical symbols, per-species atom counts returned as a 4th result {sym: [Nframe, Ncell]}
+def track_distrib_grid(db, N=2, prog=False, species=None):
     masses = []
     numbers = []
     densities = []
-    iter = 0
-    for at in db:
-        if prog:
-            iter += 1
-            print(iter)
-        frac = at.get_scaled_positions(wrap=True)
-        m = at.get_masses()
-        idx = np.sum(np.floor(frac*N)*np.array([N**2,N**1,N**0]),axis=1).astype(int)
-        masses.append([np.sum(m[idx==i]) for i in range(N**3)])
-        numbers.append([sum(idx==i) for i in range(N**3)])
-        densities.append([np.sum(m[idx==i])*(N**3)*10/6.022/at.get_volume() for i in range(N**3)])
+    if species is not None:
+        counts = {sym: [] for sym in species}
+        lut = {sym: k for k, sym in enumerate(species)}
+    for at in tqdm(db, desc='Grid distribution', disable=not prog):
+        idx, Ncell = grid_index(at, N)
+        m = np.bincount(idx, weights=at.get_masses(), minlength=Ncell)
+        masses.append(m)
+        numbers.append(np.bincount(idx, minlength=Ncell))
+        densities.append(m*Ncell*10/6.022/at.get_volume())
+        if species is not None:
+            #one bincount over (species, cell)
+            sp = np.array([lut.get(sym, -1) for sym in at.get_chemical_symbols()])
+            keep = sp >= 0
+            spc = np.bincount(sp[keep]*Ncell+idx[keep], minlength=len(species)*Ncell).reshape(len(species), Ncell)
+            for k, sym in enumerate(species):
+                counts[sym].append(spc[k])
     masses = np.array(masses)
     numbers = np.array(numbers)
-    return np.array(densities), masses/np.mean(masses, axis=1).reshape(-1,1), numbers/np.mean(numbers, axis=1).reshape(-1,1)
+    res = (np.array(densities), masses/np.mean(masses, axis=1).reshape(-1,1), numbers/np.mean(numbers, axis=1).reshape(-1,1))
+    if species is not None:
+        res += ({sym: np.array(counts[sym]) for sym in species},)
+    return res
 
-def mol_env(at, Rcut=6.0, returnEnvs=False):
+#counts neighbouring molecules of each type within Rcut: [Nmol, len(lbs)]
+#molSym integer encoded on lbs, sparse neighbour pairs scattered with a single bincount
+#molecules whose type is not in lbs are not counted
+def mol_env_counts(at, lbs, Rcut=6.0, backend='auto'):
     Nmol = len(at)
+    names, inv = np.unique(at.arrays['molSym'], return_inverse=True)
+    lut = np.array([lbs.index(n) if n in lbs else -1 for n in names])
+    codes = lut[inv]
+    row, col = nb_pairs(neighbor_search(at, Rcut/2, skin=0.3, backend=backend))
+    keep = codes[col] >= 0
+    counts = np.bincount(row[keep]*len(lbs)+codes[col[keep]], minlength=Nmol*len(lbs))
+    return counts.reshape(Nmol, len(lbs))
+
+def mol_env(at, Rcut=6.0, returnEnvs=False, backend='auto'):
     molSym = at.arrays['molSym']
-    molEnv = dict()
-    molEnvArr = []
     lbs = list(np.unique(molSym))
+    counts = mol_env_counts(at, lbs, Rcut, backend)
+    molEnv = dict()
     for lb in lbs:
-        molEnv[lb] = []
-    nbLst = neighborlist.NeighborList([Rcut/2]*len(at), self_interaction=False, bothways=True)
-    nbLst.update(at)
-    S = nbLst.get_connectivity_matrix(sparse=False)
-    for i in range(Nmol):
-        counts = np.unique(molSym[S[i,:]==1], return_counts=True)
-        buf = []
-        for lb in lbs:
-            if lb in counts[0]:
-                buf.append(counts[1][list(counts[0]).index(lb)])
-            else:
-                buf.append(0)
-        molEnv[molSym[i]].append(np.array(buf))
-        molEnvArr.append(np.array(buf))
-    for lb in lbs:
-        #molEnv[lb] = np.concatenate(molEnv[lb]) - will not work, creates a 1D array
-        molEnv[lb] = np.array(molEnv[lb])
+        molEnv[lb] = counts[molSym==lb]
     if returnEnvs:
-        at.arrays['molEnv'] = np.array(molEnvArr)
+        at.arrays['molEnv'] = counts
         at.info['molEnvLb'] = lbs
     return molEnv
 
@@ -334,73 +661,186 @@ def sublist(subls, totls):
             return False, None
     return True, idx
 
-def mol_envs(moldb, lbs, Rcut=6.0, returnEnvs=False):
+#environments over a trajectory: per-frame counts are collected and concatenated once
+def mol_envs(moldb, lbs, Rcut=6.0, returnEnvs=False, backend='auto'):
     menvs = dict()
     for lb in lbs:
-        menvs[lb] = np.empty(shape=[0,len(lbs)]).astype(int)
+        menvs[lb] = [np.empty(shape=[0,len(lbs)]).astype(int)]
     for at in tqdm(moldb, desc='Finding environments'):
-        menv = mol_env(at, Rcut, returnEnvs)
-        nlbs = list(menv.keys())
-        is_sublist, mask = sublist(nlbs, lbs)
+        molSym = at.arrays['molSym']
+        is_sublist, _ = sublist(list(np.unique(molSym)), lbs)
         if is_sublist:
-            for lb in nlbs:
-                buf = np.zeros([menv[lb].shape[0], len(lbs)]).astype(int)
-                buf[:,mask] = menv[lb] #if less molecules, e.g. only EMC, fill out rest with zero
-                menvs[lb] = np.vstack([menvs[lb], buf])
+            #if less molecules, e.g. only EMC, the missing types stay zero
+            counts = mol_env_counts(at, lbs, Rcut, backend)
+            for lb in lbs:
+                menvs[lb].append(counts[molSym==lb])
             if returnEnvs:
-                buf = np.zeros([len(at), len(lbs)]).astype(int)
-                buf[:,mask] = at.arrays['molEnv']
                 at.info['molEnvLb'] = lbs
-                at.arrays['molEnv'] = buf
+                at.arrays['molEnv'] = counts
+    for lb in lbs:
+        menvs[lb] = np.concatenate(menvs[lb])
     return menvs
 
-def compute_rdfs(at, rmax, nbins):
+#environments from COM arrays (extract_molecs_com) into a preallocated [Nframe, Nmol, len(lbs)] array
+def mol_envs_com(com, cells, molSym, lbs, Rcut=6.0, backend='auto'):
+    envs = np.zeros((len(com), len(molSym), len(lbs)), dtype=int)
+    for f in tqdm(range(len(com)), desc='Finding environments'):
+        at = Atoms(positions=com[f], cell=cells[f], pbc=True)
+        at.arrays['molSym'] = np.asarray(molSym)
+        envs[f] = mol_env_counts(at, lbs, Rcut, backend)
+    return envs
+
+#species resolved COM-COM rdfs and running coordination numbers from COM arrays (extract_molecs_com)
+#one neighbour search per frame within rmax, ordered pairs (A,B) histogrammed with a single bincount
+#keys 'A-B' (B around A, e.g. 'Li-EC'): rdfs[key] = g_AB(r) averaged over frames,
+#cn[key] = mean number of B molecules within redges[1:] of an A molecule
+def com_rdfs(com, cells, molSym, rmax, nbins, lbs=None, backend='auto'):
+    molSym = np.asarray(molSym)
+    if lbs is None:
+        lbs = list(np.unique(molSym))
+    Ns = len(lbs)
+    names, inv = np.unique(molSym, return_inverse=True)
+    lut = np.array([lbs.index(n) if n in lbs else -1 for n in names])
+    codes = lut[inv]
+    Nsp = np.array([np.sum(codes==a) for a in range(Ns)])
+    dr = float(rmax/nbins)
+    redges = np.arange(nbins+1)*dr
+    hist = np.zeros((Ns, Ns, nbins))
+    ghist = np.zeros((Ns, Ns, nbins))
+    for f in tqdm(range(len(com)), desc='Computing COM rdfs'):
+        at = Atoms(positions=com[f], cell=cells[f], pbc=True)
+        nb = neighbor_search(at, rmax/2, backend=backend)
+        i, j = nb_pairs(nb)
+        idx = np.floor(nb['dists']/dr).astype(int)
+        keep = (idx < nbins) & (codes[i] >= 0) & (codes[j] >= 0)
+        h = np.bincount((codes[i[keep]]*Ns+codes[j[keep]])*nbins+idx[keep], minlength=Ns*Ns*nbins).reshape(Ns, Ns, nbins)
+        hist += h
+        ghist += h*at.get_volume()
+    Nf = len(com)
+    shell = 4.0/3.0*np.pi*np.diff(redges**3)
+    #B density around A: (N_B - [A==B])/V
+    pairN = Nsp.reshape(-1,1)*(Nsp.reshape(1,-1)-np.eye(Ns))
+    rdfs = dict()
+    cn = dict()
+    for a in range(Ns):
+        for b in range(Ns):
+            key = lbs[a]+'-'+lbs[b]
+            rdfs[key] = ghist[a,b]/max(Nf*pairN[a,b], 1)/shell
+            cn[key] = np.cumsum(hist[a,b])/max(Nf*Nsp[a], 1)
+    r = 0.5*(redges[1:]+redges[:-1])
+    return dict(r=r, redges=redges, rdfs=rdfs, cn=cn)
+
+#coordination number of B around A ('A-B') at any cutoff Rc <= rmax, from com_rdfs
+#(mol_envs(..., Rcut) counts within Rcut+0.6, the ase neighbour skin)
+def com_coordination(res, key, Rc):
+    return np.interp(Rc, res['redges'], np.r_[0.0, res['cn'][key]])
+
+#intra- and inter-molecular partial rdfs of all element pairs, in one pass over the
+#neighbour pairs within rmax (no N*N distance matrix), pairs split by comparing molIDs
+#legacy normalisation of ase.ga.utilities.get_rdf*Nz1/N (x2 for z1!=z2) as in ASE < 3.27:
+#2*Npairs*V/(4pi*dr*N^2*(r^2+dr^2/12)), ASE >= 3.27 normalises partial rdfs differently
+#(Nz1*Nz2/V and exact shell volumes), results are not comparable with its get_rdf
+def compute_rdfs(at, rmax, nbins, topo=None, backend='auto'):
     rdfs = {}
     N = len(at)
-    z_counts = dict([(x,y) for x,y in zip(*np.unique(at.numbers, return_counts=True))])
-    dm = at.get_all_distances(mic=True)
-    intra_mask = find_molecs([at], return_mask=True)[0]
-    for z1 in z_counts:
-        for z2 in z_counts:
-            if z2<z1:
-                continue
-            rdf, r = get_rdf(atoms=at, rmax=rmax, nbins=nbins, distance_matrix=dm*intra_mask, elements=[z1,z2], no_dists=False)
-            if z2>z1:
-                rdf *= 2.0
-            rdfs[chem_syms[z1]+chem_syms[z2]+'_intra'] = rdf*z_counts[z1]/N
-    inter_mask = 1-intra_mask
-    for z1 in z_counts:
-        for z2 in z_counts:
-            if z2<z1:
-                continue
-            rdf, r = get_rdf(atoms=at, rmax=rmax, nbins=nbins, distance_matrix=dm*inter_mask, elements=[z1,z2], no_dists=False)
-            if z2>z1:
-                rdf *= 2.0
-            rdfs[chem_syms[z1]+chem_syms[z2]+'_inter'] = rdf*z_counts[z1]/N
+    zs = np.unique(at.numbers)
+    Nz = len(zs)
+    find_molecs([at], topo=topo, backend=backend)
+    molID = at.arrays['molID']
+    nb = neighbor_search(at, rmax/2, backend=backend, bothways=False)
+    i, j = nb_pairs(nb)
+    dr = float(rmax/nbins)
+    idx = np.ceil(nb['dists']/dr).astype(int)
+    keep = (idx >= 1) & (idx <= nbins)
+    i, j, idx = i[keep], j[keep], idx[keep]
+    zi = np.searchsorted(zs, at.numbers[i])
+    zj = np.searchsorted(zs, at.numbers[j])
+    pair = np.minimum(zi, zj)*Nz+np.maximum(zi, zj)
+    inter = (molID[i] != molID[j]).astype(int)
+    hist = np.bincount((inter*Nz*Nz+pair)*(nbins+1)+idx, minlength=2*Nz*Nz*(nbins+1)).reshape(2, Nz*Nz, nbins+1)
+    r = (np.arange(1, nbins+1)-0.5)*dr
+    norm = 4.0*np.pi*dr*N*N/at.get_volume()*(r**2+dr**2/12.)
+    for k, tag in enumerate(['_intra', '_inter']):
+        for a in range(Nz):
+            for b in range(a, Nz):
+                rdfs[chem_syms[zs[a]]+chem_syms[zs[b]]+tag] = 2.0*hist[k, a*Nz+b, 1:]/norm
     return rdfs, r
 
-def compute_rdfs_traj_avg(traj, rmax, nbins):
-    N = len(traj)
-    rdfs, r = compute_rdfs(traj[0], rmax, nbins)
-    for at in traj[1:]:
-        tmp_rdfs, _ = compute_rdfs(at, rmax, nbins)
-        for d in tmp_rdfs:
-            rdfs[d] += tmp_rdfs[d]
-    for d in rdfs:
-        rdfs[d] /= N
-    return rdfs, r
+#single pass rdf accumulator for frames from any iterator (list, TrajLoader.iterTraj, ...)
+#per-frame rdfs are averaged over windows of `win` frames, window averages are reduced
+#into running mean/M2 (Welford), partial accumulators are merged with merge()
+class RDFAccumulator:
+    def __init__(self, rmax, nbins, win=1, topo=None, backend='auto'):
+        self.rmax = rmax
+        self.nbins = nbins
+        self.win = win
+        self.topo = topo
+        self.backend = backend
+        self.r = None
+        self.Nframe = 0     #all frames
+        self.total = {}     #sum of per-frame rdfs
+        self.buf = []       #per-frame rdfs of the open window (< win frames)
+        self.Nwin = 0       #closed windows
+        self.mean = {}
+        self.M2 = {}
+
+    def add(self, at):
+        rdfs, self.r = compute_rdfs(at, self.rmax, self.nbins, self.topo, self.backend)
+        for d in rdfs:
+            self.total[d] = self.total.get(d, 0.0)+rdfs[d]
+        self.Nframe += 1
+        self._push(rdfs)
+
+    def update(self, frames):
+        for at in frames:
+            self.add(at)
+        return self
+
+    #windows are closed at exactly win frames
+    def _push(self, rdfs):
+        self.buf.append(rdfs)
+        if len(self.buf) == self.win:
+            self._merge_windows(1, {d: sum(f[d] for f in self.buf)/self.win for d in self.buf[0]}, {})
+            self.buf = []
+
+    def _merge_windows(self, Nb, meanb, M2b):
+        Na = self.Nwin
+        N = Na+Nb
+        for d in meanb:
+            ma = self.mean.get(d, 0.0)
+            delta = meanb[d]-ma
+            self.mean[d] = ma+delta*Nb/N
+            self.M2[d] = self.M2.get(d, 0.0)+M2b.get(d, 0.0)+delta**2*Na*Nb/N
+        self.Nwin = N
+
+    #reduces another accumulator (e.g. from another process) into this one; the frames
+    #of the other open window continue this one, so that window may join the tails of
+    #two segments (the window statistics then differ slightly from a serial pass)
+    def merge(self, other):
+        if other.Nwin:
+            self._merge_windows(other.Nwin, other.mean, other.M2)
+        for d in other.total:
+            self.total[d] = self.total.get(d, 0.0)+other.total[d]
+        self.Nframe += other.Nframe
+        if self.r is None:
+            self.r = other.r
+        for rdfs in other.buf:
+            self._push(rdfs)
+        return self
+
+    #average over all frames, as compute_rdfs_traj_avg
+    def average(self):
+        return {d: self.total[d]/self.Nframe for d in self.total}, self.r
+
+    #window statistics (full windows only), as compute_rdfs_traj_stats
+    def stats(self):
+        rdfs = {}
+        for d in self.mean:
+            rdfs[d] = {'avg': list(self.mean[d]), 'std': list(np.sqrt(self.M2[d]/self.Nwin))}
+        return {'rdfs': rdfs, 'r': list(self.r)}
+
+def compute_rdfs_traj_avg(traj, rmax, nbins, topo=None, backend='auto'):
+    return RDFAccumulator(rmax, nbins, topo=topo, backend=backend).update(traj).average()
 
-def compute_rdfs_traj_stats(traj, rmax, nbins, win=1):
-    N = np.floor(len(traj)/win).astype(int)
-    rdfs, r = compute_rdfs_traj_avg(traj[slice(0, win)], rmax, nbins)
-    for d in rdfs:
-        rdfs[d] = [rdfs[d]]
-    for i in range(1,N):
-        tmp_rdfs, _ = compute_rdfs_traj_avg(traj[slice(win*i, win*(i+1))], rmax, nbins)
-        for d in tmp_rdfs:
-            rdfs[d] += [tmp_rdfs[d]]
-    for d in rdfs:
-        rdfs[d] = np.array(rdfs[d])
-    for d in rdfs:
-        rdfs[d] = {'avg': list(np.mean(rdfs[d], axis=0)), 'std': list(np.std(rdfs[d], axis=0))}
-    return {'rdfs': rdfs, 'r': list(r)}
+def compute_rdfs_traj_stats(traj, rmax, nbins, win=1, topo=None, backend='auto'):
+    return RDFAccumulator(rmax, nbins, win=win, topo=topo, backend=backend).update(traj).stats()
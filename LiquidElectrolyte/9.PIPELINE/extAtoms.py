@@ -1,15 +1,113 @@
 import numpy as np
 import hashlib
+import json
+import os
+import ase.data
 
-#creates unique hash for a matrix of numbers
-def hash_array(v):
+#creates unique hash for a matrix of numbers: md5 of the raw bytes of the numbers
+#quantised to `precision` decimals (shape included, -0.0 and 0.0 hash the same)
+def hash_array(v, precision=8):
+    q = np.round(np.asarray(v, dtype=np.float64)*10**precision).astype(np.int64)
+    h = hashlib.md5(np.array(q.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(q).tobytes())
+    return h.hexdigest()
+
+#text based hash of the previous versions, to match uids stored in older files
+def hash_array_str(v):
     return hashlib.md5(np.array2string(v, precision=8, sign='+', floatmode='fixed').encode()).hexdigest()
 
 #creates unique hash for Atoms from atomic numbers and positions
-def hash_atoms(db):
-    for at in db:
-        v = np.concatenate((at.numbers.reshape(-1,1), at.positions),axis=1)
-        at.info['uid'] = hash_array(v)
+#all configurations are quantised at once, then hashed slice by slice
+def hash_atoms(db, precision=8, legacy=False):
+    if legacy:
+        for at in db:
+            v = np.concatenate((at.numbers.reshape(-1,1), at.positions),axis=1)
+            at.info['uid'] = hash_array_str(v)
+        return
+    if len(db) == 0:
+        return
+    nat = np.array([len(at) for at in db])
+    offsets = np.r_[0, np.cumsum(nat)]
+    v = np.concatenate([np.concatenate((at.numbers.reshape(-1,1), at.positions),axis=1) for at in db])
+    q = np.round(v*10**precision).astype(np.int64)
+    for i, at in enumerate(db):
+        h = hashlib.md5(np.array([nat[i], 4], dtype=np.int64).tobytes())
+        h.update(q[offsets[i]:offsets[i+1]].tobytes())
+        at.info['uid'] = h.hexdigest()
+
+#lookup tables of a list of Atoms: uid, config_type and property name -> indices
+#built in one pass over db; save/load keep it (with the uids) next to the xyz file it was read from
+class DBIndex:
+    def __init__(self, db=None):
+        self.uids = []
+        self.maps = {'uid': {}, 'config_type': {}, 'prop': {}}
+        if db is not None:
+            self.build(db)
+
+    def build(self, db):
+        self.uids = [at.info.get('uid') for at in db]
+        self.maps = {'uid': {}, 'config_type': {}, 'prop': {}}
+        for i, at in enumerate(db):
+            self.maps['uid'].setdefault(at.info.get('uid'), []).append(i)
+            self.maps['config_type'].setdefault(at.info.get('config_type'), []).append(i)
+            for prop in list(at.info.keys())+list(at.arrays.keys()):
+                self.maps['prop'].setdefault(prop, []).append(i)
+        return self
+
+    def __len__(self):
+        return len(self.uids)
+
+    def lookup(self, key, value):
+        return self.maps[key].get(value, [])
+
+    def select(self, db, key, value):
+        return [db[i] for i in self.lookup(key, value)]
+
+    def save(self, fname, xyz_file=None):
+        data = dict(uids=self.uids, maps=self.maps)
+        if xyz_file is not None:
+            stat = os.stat(xyz_file)
+            data.update(size=stat.st_size, mtime=stat.st_mtime)
+        with open(fname, 'w') as f:
+            json.dump(data, f)
+
+    #returns None if the index does not match xyz_file (size/mtime) or db (length)
+    @classmethod
+    def load(cls, fname, xyz_file=None, db=None):
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'r') as f:
+            data = json.load(f)
+        if xyz_file is not None:
+            stat = os.stat(xyz_file)
+            if data.get('size') != stat.st_size or data.get('mtime') != stat.st_mtime:
+                return None
+        if db is not None and len(db) != len(data['uids']):
+            return None
+        index = cls()
+        index.uids = data['uids']
+        index.maps = {key: {(None if k == 'null' else k): v for k, v in m.items()} for key, m in data['maps'].items()}
+        return index
+
+#index of the configurations read from xyz_file, from its sidecar <xyz_file>.uidx.json when up to date;
+#otherwise uids are hashed (if missing) and the index is built and saved. Stored uids are restored into db.
+def db_index(db, xyz_file=None, precision=8):
+    fname = xyz_file+'.uidx.json' if xyz_file is not None else None
+    if fname is not None:
+        index = DBIndex.load(fname, xyz_file, db)
+        if index is not None:
+            for at, uid in zip(db, index.uids):
+                at.info['uid'] = uid
+            return index
+    missing = [at for at in db if 'uid' not in at.info]
+    hash_atoms(missing, precision)
+    index = DBIndex(db)
+    if fname is not None:
+        try:
+            index.save(fname, xyz_file)
+        except OSError as err:
+            print(f"uid index not saved ({err})")
+    return index
 
 #prints all available properties in list of Atoms
 def check_keys(db):
@@ -17,7 +115,9 @@ def check_keys(db):
         print([at.info['config_type']]+list(at.info.keys())+list(at.arrays.keys()))
 
 #selects configurations which have property
-def sel_by_prop(db, prop):
+def sel_by_prop(db, prop, index=None):
+    if index is not None:
+        return index.select(db, 'prop', prop)
     reflist = []
     for at in db:
         props = list(at.info.keys())+list(at.arrays.keys())
@@ -26,7 +126,9 @@ def sel_by_prop(db, prop):
     return reflist
 
 #selects configurations by uid
-def sel_by_uid(db, uid):
+def sel_by_uid(db, uid, index=None):
+    if index is not None:
+        return index.select(db, 'uid', uid)
     reflist = []
     for at in db:
         if uid == at.info['uid']:
@@ -34,7 +136,9 @@ def sel_by_uid(db, uid):
     return reflist
 
 #selects configurations of a certain config_type
-def sel_by_conf_type(db, config_type):
+def sel_by_conf_type(db, config_type, index=None):
+    if index is not None:
+        return index.select(db, 'config_type', config_type)
     reflist = []
     for at in db:
         if (at.info['config_type'] == config_type):
@@ -90,8 +194,109 @@ def get_E0(db, tag=''):
             E0[at.get_chemical_symbols()[0]]=at.info['energy'+tag]
     return E0
 
-#returns desired property for list of Atoms
-def get_prop(db, type, prop='', peratom=False):
+#columnar view of the properties of a list of Atoms, gathered once and cached:
+#info scalars/tensors as [Nconf,...] arrays, per-atom arrays as one flat [Nat_total,...] buffer
+#split by offsets, composition matrix [Nconf, Nel] for E0 and binding energies
+#set() writes into the columns only, flush() propagates them back to the Atoms
+class PropStore:
+    def __init__(self, db):
+        self.db = db
+        self.nat = np.array([len(at) for at in db])
+        self.offsets = np.r_[0, np.cumsum(self.nat)]
+        numbers = np.concatenate([at.numbers for at in db]) if len(db) else np.zeros(0, dtype=int)
+        self.elements, inv = np.unique(numbers, return_inverse=True)
+        conf = np.repeat(np.arange(len(db)), self.nat)
+        Nel = len(self.elements)
+        self.composition = np.bincount(conf*Nel+inv, minlength=len(db)*Nel).reshape(len(db), Nel)
+        self.columns = {'info': {}, 'arrays': {}}
+        self.dirty = set()
+        self._E0 = {}
+
+    def info(self, prop):
+        if prop not in self.columns['info']:
+            self.columns['info'][prop] = np.array([at.info[prop] for at in self.db])
+        return self.columns['info'][prop]
+
+    def arrays(self, prop):
+        if prop not in self.columns['arrays']:
+            self.columns['arrays'][prop] = np.concatenate([at.arrays[prop] for at in self.db])
+        return self.columns['arrays'][prop]
+
+    #per configuration list of a flat per-atom buffer
+    def split(self, flat):
+        return np.split(flat, self.offsets[1:-1])
+
+    #flat per-atom buffer divided by the number of atoms of its configuration
+    def arrays_peratom(self, prop):
+        flat = self.arrays(prop)
+        return flat/np.repeat(self.nat, self.nat).reshape((-1,)+(1,)*(flat.ndim-1))
+
+    #E0 per element from the single atom configurations, as get_E0
+    def E0(self, tag=''):
+        if tag not in self._E0:
+            E0 = np.full(len(self.elements), np.nan)
+            single = np.flatnonzero(self.nat == 1)
+            E = self.info('energy'+tag)
+            for i in single:
+                E0[np.argmax(self.composition[i])] = E[i]
+            self._E0[tag] = E0
+        return self._E0[tag]
+
+    def bind(self, tag=''):
+        E0 = self.E0(tag)
+        used = np.any(self.composition > 0, axis=0)
+        if np.any(np.isnan(E0[used])):
+            missing = [ase.data.chemical_symbols[z] for z in self.elements[used & np.isnan(E0)]]
+            raise KeyError('No E0 for '+' '.join(missing))
+        return self.info('energy'+tag)-self.composition@np.nan_to_num(E0)
+
+    def get(self, type, prop='', peratom=False):
+        N = self.nat if peratom else np.ones(len(self.db), dtype=int)
+        if type == 'info':
+            v = self.info(prop)
+            return v/N.reshape((-1,)+(1,)*(v.ndim-1))
+        if type == 'arrays':
+            flat = self.arrays_peratom(prop) if peratom else self.arrays(prop)
+            return np.array(self.split(flat), dtype=object)
+        if type == 'cell':
+            return np.array([at.cell[:] for at in self.db])/N.reshape(-1,1,1)
+        if type == 'meth':
+            v = np.array([getattr(at, prop)() for at in self.db])
+            return v/N.reshape((-1,)+(1,)*(v.ndim-1))
+        if type == 'bind':
+            return self.bind(prop)/N
+
+    #prop: [Nconf,...] for info; for arrays a per configuration list, a regular
+    #[Nconf,Nat,...] array (as set_prop) or a flat [Nat_total,...] buffer
+    def set(self, type, prop, tag):
+        if type == 'arrays':
+            if not isinstance(prop, np.ndarray) or prop.dtype == object:
+                prop = np.concatenate(list(prop))
+            elif prop.ndim > 1 and prop.shape[0] == len(self.db) and np.all(self.nat == prop.shape[1]):
+                prop = prop.reshape((-1,)+prop.shape[2:])
+            elif prop.shape[0] != self.offsets[-1]:
+                raise ValueError(f'Shape {prop.shape} is neither per configuration ({len(self.db)}) '
+                                 f'nor per atom ({self.offsets[-1]})')
+        self.columns[type][tag] = np.asarray(prop)
+        self.dirty.add((type, tag))
+
+    def flush(self, tags=None):
+        for type, tag in list(self.dirty):
+            if tags is not None and tag not in tags:
+                continue
+            col = self.columns[type][tag]
+            if type == 'info':
+                for at, v in zip(self.db, col):
+                    at.info[tag] = v
+            else:
+                for at, v in zip(self.db, self.split(col)):
+                    at.arrays[tag] = v
+            self.dirty.discard((type, tag))
+
+#returns desired property for list of Atoms (from store, a PropStore of db, when given)
+def get_prop(db, type, prop='', peratom=False, store=None):
+    if store is not None:
+        return store.get(type, prop, peratom)
     if peratom:
         N = lambda a : a.get_global_number_of_atoms()
     else:
@@ -108,7 +313,10 @@ def get_prop(db, type, prop='', peratom=False):
         E0 = get_E0(db, prop)
         return np.array(list(map(lambda a : (a.info['energy'+prop]-np.sum([E0[s] for s in a.get_chemical_symbols()]))/N(a), db)))
 
-def set_prop(db, type, prop, tag):
+def set_prop(db, type, prop, tag, store=None):
+    if store is not None:
+        store.set(type, prop, tag)
+        return
     for i,at in enumerate(db):
         if type == 'info':
             at.info[tag] = prop[i]
@@ -7,8 +7,18 @@
 # ------------------------------------------------------------
 import numpy as np
 import copy
+import contextlib
+import os
+import sys
+import json
+import hashlib
+import multiprocessing
 from tqdm import tqdm
 from quippy import descriptors
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import trajIO as tIO
+from paramHash import param_hash
+import dscrStore as dS
 
 # ------------------------------
 #
@@ -63,6 +73,16 @@ def get_turbo_parameters(param_dict):
     return dscr_str
 
 
+def frame_hash(ase_frame):
+    """content hash of a frame: numbers, positions, cell and pbc"""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(ase_frame.numbers, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(ase_frame.positions, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(ase_frame.cell[:], dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(ase_frame.pbc).tobytes())
+    return h.hexdigest()
+
+
 def descrSaveName(param_dict,frame_tuple):
     interval_str = '-'.join(map(str,frame_tuple))
     if param_dict['type'] == 'soap':
@@ -73,7 +93,7 @@ def descrSaveName(param_dict,frame_tuple):
         '_n_Z'+str(param_dict['n_Z'])+\
         '_Z'+param_dict['Z'][1:-1]+\
         '_'+interval_str+\
-        ''
+        '_'+param_hash(param_dict)[:8]
     elif param_dict['type'] == 'soap_turbo':
         output_name = 'turbo_'+\
         'rcutH'+str(param_dict["rcut_hard"])+\
@@ -83,10 +103,68 @@ def descrSaveName(param_dict,frame_tuple):
         '_n_Z'+str(len(param_dict['Zs']))+\
         '_Z'+str(param_dict['Zs'][0])+\
         '_'+interval_str+\
-        ''
+        '_'+param_hash(param_dict)[:8]
     return output_name
 
 
+# --- thread limits of the worker processes
+# OMP_NUM_THREADS is only read when an OpenMP runtime starts, and the one of quippy
+# is already running in the parent (and so in the forked workers): it is set in the
+# parent before the Pool is created, for the runtimes not started yet, and the loaded
+# ones are capped at runtime by threadpoolctl (installed with scikit-learn)
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+@contextlib.contextmanager
+def worker_threads(n=1):
+    if threadpool_limits is None:
+        print("threadpoolctl not found: workers may use more than one OpenMP thread each")
+    keys = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+    old = {k: os.environ.get(k) for k in keys}
+    os.environ.update({k: str(n) for k in keys})
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k)
+            else:
+                os.environ[k] = v
+
+
+def limit_threads(n=1):
+    if threadpool_limits is not None:
+        threadpool_limits(n)
+
+
+# --- parallel evaluation (worker side)
+# every worker process builds its own Descriptor and trajectory reader
+# once, then writes its chunks straight into the shared output memmap
+_worker = dict()
+
+def _init_worker(dscr_str, traj_file, numbers, out_file):
+    limit_threads(1)
+    _worker['dscr_obj'] = descriptors.Descriptor(dscr_str)
+    _worker['traj'] = tIO.open_traj(traj_file)
+    _worker['numbers'] = numbers
+    _worker['out'] = np.load(out_file, mmap_mode='r+')
+
+
+def _eval_chunk(task):
+    row, frames = task
+    chunk_traj = [_worker['traj'].readFrame(f) for f in frames]
+    if _worker['numbers'] is not None:
+        for snap in chunk_traj:
+            snap.numbers = _worker['numbers']
+    ps_tmp = np.array(_worker['dscr_obj'].calc_descriptor(chunk_traj))
+    _worker['out'][row:row+len(frames)] = ps_tmp
+    _worker['out'].flush()
+    return len(frames)
+
+
 # ------------------------------
 #
 # Classes
@@ -94,6 +172,55 @@ def descrSaveName(param_dict,frame_tuple):
 # ------------------------------
 
 
+class DescriptorCache:
+    """
+    Content-addressed store of per-frame descriptors:
+    cache_dir/<param_hash>/<frame_hash>.npy. Hits refresh the file
+    mtime and the least recently used files are evicted once the
+    cache grows above max_size (bytes).
+    """
+    def __init__(self, cache_dir, max_size=10*2**30):
+        self.cacheDir = cache_dir
+        self.maxSize = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(f.stat().st_size for f in self._entries())
+    
+    def _entries(self):
+        for d in os.scandir(self.cacheDir):
+            if d.is_dir():
+                for f in os.scandir(d.path):
+                    if f.name.endswith('.npy'):
+                        yield f
+    
+    def _path(self, key, fhash):
+        return os.path.join(self.cacheDir, key, fhash+'.npy')
+    
+    def get(self, key, fhash):
+        path = self._path(key, fhash)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)
+        return np.load(path)
+    
+    def put(self, key, fhash, ps):
+        path = self._path(key, fhash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, ps)
+        self.size += os.path.getsize(path)
+        if self.size > self.maxSize:
+            self.evict()
+    
+    def evict(self):
+        # oldest access first, down to 90% of the limit
+        entries = sorted(self._entries(), key=lambda f: f.stat().st_mtime)
+        self.size = sum(f.stat().st_size for f in entries)
+        for f in entries:
+            if self.size <= 0.9*self.maxSize:
+                break
+            self.size -= f.stat().st_size
+            os.remove(f.path)
+
+
 class descriptorInit:
     def __init__(self,param_dict):
         self.mode = param_dict['type']
@@ -102,6 +229,124 @@ class descriptorInit:
     def __info__(self):
         return print(self.paramDict)
     
+    def ParallelEval(self, traj_file, frame_tuple, out_file,
+                     n_workers=None, chunk=10, numbers=None):
+        # frames b:e:s of traj_file spread in chunks over n_workers processes;
+        # output [Nframe, Ncenters, Ndescr] preallocated as .npy memmap,
+        # the centres per frame are assumed constant (fixed composition)
+        source = tIO.open_traj(traj_file)
+        frames = np.arange(*slice(*frame_tuple).indices(len(source)))
+        
+        # output layout from the first frame
+        frameZero = source.readFrame(frames[0])
+        if numbers is not None:
+            frameZero.numbers = numbers
+        ps_zero = np.array(self.dscr_obj.calc_descriptor([frameZero]))
+        out = np.lib.format.open_memmap(out_file, mode='w+', dtype=ps_zero.dtype,
+                                        shape=(len(frames),)+ps_zero.shape[1:])
+        out[0] = ps_zero[0]
+        out.flush()
+        del out
+        
+        tasks = [(r, frames[r:r+chunk]) for r in range(1, len(frames), chunk)]
+        n_workers = n_workers if n_workers else os.cpu_count()
+        with worker_threads(1), multiprocessing.Pool(n_workers, initializer=_init_worker, 
+                                  initargs=(self.dscr_str, traj_file, numbers, out_file)) as pool:
+            with tqdm(total=len(frames), initial=1, desc='Computing descriptor (parallel)') as pbar:
+                for done in pool.imap_unordered(_eval_chunk, tasks):
+                    pbar.update(done)
+        return np.load(out_file, mmap_mode='r')
+    
+    def ChunkEval(self, ase_traj, frame_tuple, chunk, cache=None, store_name=None,
+                  store_dtype=None):
+        # frames b:e:s evaluated `chunk` frames at a time into a single store:
+        #   store_name/data.npy       [Nframe, Ncenters, Ndescr] memmap
+        #   store_name/manifest.json  completed chunks, to resume after a crash
+        # ase_traj is either the list of the b:e:s frames (TrajLoader.readTraj)
+        # or a reader (TrajLoader, trajIO.FrameIndex/TrajCache) whose readFrame 
+        # is called for the pending chunks only
+        # store_dtype (float32/float16): once complete, data.npy is compacted into
+        # store_name/data.dstore (dscrStore) and a DescrStore is returned, indexed
+        # by frame as the memmap (store[f] -> [Ncenters, Ndescr], store.rows[...]
+        # for the flattened [Nframe*Ncenters, Ndescr] rows)
+        b,e,s = frame_tuple
+        lazy = hasattr(ase_traj, 'readFrame')
+        if lazy:
+            # e clamped to the trajectory length, as ParallelEval
+            frames = range(*slice(b,e,s).indices(len(ase_traj)))
+        else:
+            frames = range(b,e,s)
+        Nframe = len(frames) if lazy else min(len(frames), len(ase_traj))
+        if store_name is None:
+            store_name = descrSaveName(self.paramDict, frame_tuple)
+        os.makedirs(store_name, exist_ok=True)
+        data_file = os.path.join(store_name, 'data.npy')
+        compact_file = os.path.join(store_name, 'data.dstore')
+        manifest_file = os.path.join(store_name, 'manifest.json')
+        
+        manifest = dict(params=param_hash(self.paramDict), 
+                        frame_tuple=list(frame_tuple), chunk=chunk, done=[])
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                old = json.load(f)
+            if all(old[k] == manifest[k] for k in ['params', 'frame_tuple', 'chunk']):
+                manifest = old
+                print(f"Resuming {store_name}: {len(manifest['done'])} chunks done")
+        done = set(tuple(r) for r in manifest['done'])
+        if done and os.path.isdir(compact_file) and not os.path.isfile(data_file):
+            # already complete and compacted
+            return dS.DescrStore(compact_file)
+        
+        range_chunks = [(j, min(j+chunk, Nframe)) for j in range(0, Nframe, chunk)]
+        data = np.load(data_file, mmap_mode='r+') if done else None
+        for c,(j0,j1) in tqdm(enumerate(range_chunks), desc='Computing descriptor (chunks)',
+                              total=len(range_chunks)):
+            if (j0,j1) in done:
+                continue
+            print(f"Chunk ({c+1}): {frames[j0]} - {frames[j1-1]}")
+            if lazy:
+                chunk_tmp = [ase_traj.readFrame(f) for f in frames[j0:j1]]
+            else:
+                chunk_tmp = ase_traj[j0:j1]
+            ps_tmp = self.DirectEval(chunk_tmp, cache=cache)
+            if data is None:
+                data = np.lib.format.open_memmap(data_file, mode='w+', dtype=ps_tmp.dtype,
+                                                 shape=(Nframe,)+ps_tmp.shape[1:])
+            data[j0:j1] = ps_tmp
+            data.flush()
+            # manifest only updated once the chunk is on disk
+            manifest['done'].append([j0,j1])
+            with open(manifest_file+'.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(manifest_file+'.tmp', manifest_file)
+        del data
+        if store_dtype is not None:
+            store = dS.save_descr(compact_file, np.load(data_file, mmap_mode='r'), dtype=store_dtype)
+            os.remove(data_file)
+            return store
+        return np.load(data_file, mmap_mode='r')
+    
+    def CachedEval(self, ase_traj, cache):
+        # only the frames missing from the cache are computed
+        key = param_hash(self.paramDict)
+        hashes = [frame_hash(snap) for snap in ase_traj]
+        ps = [cache.get(key, h) for h in hashes]
+        missing = [i for i, p in enumerate(ps) if p is None]
+        if missing:
+            ps_new = self.dscr_obj.calc_descriptor([ase_traj[i] for i in missing])
+            for i, p in zip(missing, ps_new):
+                ps[i] = np.asarray(p)
+                cache.put(key, hashes[i], ps[i])
+        return np.array(ps)
+    
+    def StreamEval(self, frame_iter):
+        # consumes frames (or frame batches) as they arrive,
+        # e.g. from TrajLoader.iterTraj, yielding one array each
+        for frames in frame_iter:
+            if not isinstance(frames, list):
+                frames = [frames]
+            yield np.array(self.dscr_obj.calc_descriptor(frames))
+    
     
 class SOAPdescriptor(descriptorInit):
     def __init__(self, param_dict):
@@ -111,23 +356,12 @@ class SOAPdescriptor(descriptorInit):
         self.dscr_str = get_soap_parameters(param_dict)
         self.dscr_obj = descriptors.Descriptor(self.dscr_str)
     
-    def ChunkEval(self, ase_traj, frame_tuple, chunk):
-        b,e,s = frame_tuple
-        times = int(e/chunk)
-        range_chunks = [np.arange(0+chunk*u,chunk+chunk*u+1,s) for u in range(times)]
-        for c,range_ in tqdm(enumerate(range_chunks), desc='Computing descriptor (chunks)'):
-            print(f"Chunk ({c+1}): {range_[0]} - {range_[-1]}")
-            chunk_tmp = ase_traj[range_[0]:range_[-1]]
-            ps_tmp = self.dscr_obj.calc_descriptor(chunk_tmp)
-            # saving to file
-            frame_tpl_tmp = (range_[0],range_[-1],1)
-            file_name_tmp = descrSaveName(param_dict,frame_tpl_tmp)
-            np.save(file_name_tmp,ps_tmp)
-            
     # def ChunkEvalEmbedded(ase_traj, embedObj, frame_tuple, chunk):
     #     pass
             
-    def DirectEval(self, ase_traj):
+    def DirectEval(self, ase_traj, cache=None):
+        if cache is not None:
+            return self.CachedEval(ase_traj, cache)
         return np.array(self.dscr_obj.calc_descriptor(ase_traj))
     
     
@@ -139,18 +373,7 @@ class TURBOdescriptor(descriptorInit):
         self.dscr_str = get_turbo_parameters(param_dict)
         self.dscr_obj = descriptors.Descriptor(self.dscr_str)
     
-    def ChunkEval(self, ase_traj, frame_tuple, chunk):
-        b,e,s = frame_tuple
-        times = int(e/chunk)
-        range_chunks = [np.arange(0+chunk*u,chunk+chunk*u+1,s) for u in range(times)]
-        for c,range_ in tqdm(enumerate(range_chunks), desc='Computing descriptor (chunks)'):
-            print(f"Chunk ({c+1}): {range_[0]} - {range_[-1]}")
-            chunk_tmp = ase_traj[range_[0]:range_[-1]]
-            ps_tmp = self.dscr_obj.calc_descriptor(chunk_tmp)
-            # saving to file
-            frame_tpl_tmp = (range_[0],range_[-1],1)
-            file_name_tmp = descrSaveName(self.param_dict,frame_tpl_tmp)
-            np.save(file_name_tmp,ps_tmp)
-              
-    def DirectEval(self, ase_traj):
+    def DirectEval(self, ase_traj, cache=None):
+        if cache is not None:
+            return self.CachedEval(ase_traj, cache)
         return np.array(self.dscr_obj.calc_descriptor(ase_traj))
\ No newline at end of file
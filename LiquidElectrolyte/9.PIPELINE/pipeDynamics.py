@@ -0,0 +1,65 @@
+#!
+
+# ------------------------------------------------------------
+#
+# Dynamics utilities (MSD, diffusion)
+#
+# ------------------------------------------------------------
+import numpy as np
+
+# ------------------------------
+#
+# Functions
+#
+# ------------------------------
+
+
+def msd_fft(xyz):
+    # assuming shape (Nat,Nframe,XYZ), unwrapped (e.g. TrajLoader.trajUnwrapper)
+    # MSD averaged over all time origins, per particle (Nat,Nframe):
+    # msd(m) = S1(m) - 2*S2(m) with S2 the position autocorrelation (Wiener-Khinchin)
+    xyz = np.asarray(xyz, dtype=float)
+    N = xyz.shape[1]
+    norm = N - np.arange(N)
+    # S1(m) = sum_k [r^2(k) + r^2(k+m)] / (N-m)
+    D = np.sum(xyz**2, axis=2)
+    C = np.cumsum(D, axis=1)
+    head = C[:, ::-1]
+    tail = C[:, -1:] - np.hstack([np.zeros((len(xyz),1)), C[:, :-1]])
+    S1 = (head + tail)/norm
+    # S2(m) = sum_k r(k).r(k+m) / (N-m), zero padded FFT
+    F = np.fft.rfft(xyz, n=2*N, axis=1)
+    S2 = np.sum(np.fft.irfft(F*F.conjugate(), axis=1)[:, :N], axis=2)/norm
+    return S1 - 2*S2
+
+
+def fit_diffusion(msd, dt, fit_range=(0.1,0.5), dim=3):
+    # D from the slope of the particle averaged msd (Nframe) over a window of lags,
+    # fit_range as fractions of the trajectory length; units: [xyz]^2/[dt]
+    N = len(msd)
+    t = np.arange(N)*dt
+    i0, i1 = int(fit_range[0]*N), max(int(fit_range[1]*N), int(fit_range[0]*N)+2)
+    slope = np.polyfit(t[i0:i1], msd[i0:i1], 1)[0]
+    return slope/(2*dim)
+
+
+def block_diffusion(xyz, dt, n_blocks=5, fit_range=(0.1,0.5)):
+    # trajectory cut in n_blocks contiguous time blocks, one D per block:
+    # returns mean D and its standard error
+    N = np.shape(xyz)[1]//n_blocks
+    Ds = [fit_diffusion(np.mean(msd_fft(xyz[:, b*N:(b+1)*N]), axis=0), dt, fit_range)
+          for b in range(n_blocks)]
+    return np.mean(Ds), np.std(Ds, ddof=1)/np.sqrt(n_blocks), np.array(Ds)
+
+
+def species_diffusion(unwrapped_coords, dt, n_blocks=5, fit_range=(0.1,0.5)):
+    # per species self-diffusion from the trajUnwrapper output
+    # {species: (Nmol,Nframe,3)}; dt = time between the stored frames
+    results = dict()
+    for key, xyz in unwrapped_coords.items():
+        msd = np.mean(msd_fft(xyz), axis=0)
+        D, D_err, D_blocks = block_diffusion(xyz, dt, n_blocks, fit_range)
+        results[key] = dict(t=np.arange(len(msd))*dt, msd=msd,
+                            D=fit_diffusion(msd, dt, fit_range),
+                            D_block=D, D_err=D_err, D_blocks=D_blocks)
+    return results
@@ -0,0 +1,224 @@
+#!
+
+# ------------------------------------------------------------
+#
+# Descriptor parameter sweeps (SOAP / turbo-SOAP)
+#
+# ------------------------------------------------------------
+import numpy as np
+import copy
+import itertools
+import json
+import os
+import sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from ase import Atoms
+from tqdm import tqdm
+from quippy import descriptors
+import pipeDescriptor as pD
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import trajIO as tIO
+
+# ------------------------------
+#
+# Functions
+#
+# ------------------------------
+
+
+def set_param(param_dict, key, value):
+    # nested keys with dots, e.g. 'multi.alpha_max'
+    *path, last = key.split('.')
+    d = param_dict
+    for k in path:
+        d = d[k]
+    d[last] = value
+
+
+def expand_grid(base_dict, grid):
+    """
+    All the combinations of the grid values applied on top of base_dict.
+    grid: {key: [values]}, nested keys with dots ('multi.alpha_max'),
+    tuple keys vary together, e.g. {('rcut_hard','rcut_soft'): [(4.5,3.5),(5.0,4.0)]}
+    """
+    keys = list(grid.keys())
+    param_list = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        params = copy.deepcopy(base_dict)
+        for key, value in zip(keys, values):
+            if isinstance(key, tuple):
+                for k, v in zip(key, value):
+                    set_param(params, k, v)
+            else:
+                set_param(params, key, value)
+        param_list.append(params)
+    return param_list
+
+
+def dscr_string(param_dict):
+    if param_dict['type'] == 'soap':
+        return pD.get_soap_parameters(param_dict)
+    elif param_dict['type'] == 'soap_turbo':
+        # get_turbo_parameters rewrites central_index in place
+        return pD.get_turbo_parameters(copy.deepcopy(param_dict))
+    else:
+        raise NameError('Unknown descriptor type '+str(param_dict['type']))
+
+
+# --- shared frames
+# positions [Nframe,Nat,3] and cells [Nframe,3,3] in shared memory blocks,
+# numbers and pbc are passed by value (constant number of atoms)
+
+def _to_shared(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return shm, dict(name=shm.name, shape=arr.shape, dtype=arr.dtype.str)
+
+
+def _from_shared(spec):
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    return shm, np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=shm.buf)
+
+
+# --- worker side
+# every worker attaches to the shared frames once, then evaluates whole grid points
+
+_worker = dict()
+
+def _init_sweep_worker(pos_spec, cell_spec, numbers, pbc, out_dir):
+    pD.limit_threads(1)
+    _worker['shm'] = []
+    for key, spec in [('positions', pos_spec), ('cells', cell_spec)]:
+        shm, arr = _from_shared(spec)
+        _worker['shm'].append(shm)
+        _worker[key] = arr
+    _worker['numbers'] = numbers
+    _worker['pbc'] = pbc
+    _worker['out_dir'] = out_dir
+
+
+def _frames():
+    return [Atoms(numbers=_worker['numbers'], positions=pos, cell=cell, pbc=_worker['pbc'])
+            for pos, cell in zip(_worker['positions'], _worker['cells'])]
+
+
+def _eval_point(task):
+    gid, params, out_name = task
+    dscr_str = dscr_string(params)
+    t0 = time.time()
+    dscr_obj = descriptors.Descriptor(dscr_str)
+    t1 = time.time()
+    ps = np.array(dscr_obj.calc_descriptor(_frames()))
+    t2 = time.time()
+    out_file = os.path.join(_worker['out_dir'], out_name+'.npy')
+    np.save(out_file, ps)
+    Nframe = len(_worker['positions'])
+    return dict(id=gid, params=params, hash=pD.param_hash(params), dscr_str=dscr_str,
+                file=out_file, shape=list(ps.shape), dim=int(ps.shape[-1]),
+                t_init=t1-t0, t_eval=t2-t1, frames_per_s=Nframe/(t2-t1),
+                atoms_per_s=Nframe*len(_worker['numbers'])/(t2-t1))
+
+
+# ------------------------------
+#
+# Classes
+#
+# ------------------------------
+
+
+class ParamSweep:
+    """
+    Evaluates a descriptor over a grid of parameters on the same frames.
+    Frames are loaded once into shared memory and the grid points are
+    spread over worker processes. Every result is stored as
+    out_dir/<descrSaveName>.npy and recorded in out_dir/sweep.json with
+    its full parameter dict, timing and descriptor dimension; points
+    already in sweep.json are skipped when the sweep is run again.
+    """
+    def __init__(self, base_dict, grid, out_dir='sweep'):
+        self.baseDict = base_dict
+        self.grid = grid
+        self.paramList = expand_grid(base_dict, grid)
+        self.outDir = out_dir
+        self.recordFile = os.path.join(out_dir, 'sweep.json')
+        self.frameTuple = None
+        self.frames = None
+        os.makedirs(out_dir, exist_ok=True)
+
+    def loadFrames(self, source, frame_tuple):
+        # source: trajectory file, frame reader (readFrame) or list of Atoms
+        b,e,s = frame_tuple
+        if isinstance(source, str):
+            source = tIO.open_traj(source)
+        if hasattr(source, 'readFrame'):
+            # e clamped to the trajectory length, as ChunkEval
+            self.frames = [source.readFrame(f) for f in range(*slice(b,e,s).indices(len(source)))]
+        else:
+            self.frames = list(source)[b:e:s]
+        self.frameTuple = frame_tuple
+        return self.frames
+
+    def loadRecords(self):
+        if not os.path.isfile(self.recordFile):
+            return []
+        with open(self.recordFile, 'r') as f:
+            return json.load(f)
+
+    def saveRecords(self, records):
+        with open(self.recordFile+'.tmp', 'w') as f:
+            json.dump(records, f, indent=1, default=str)
+        os.replace(self.recordFile+'.tmp', self.recordFile)
+
+    def run(self, n_workers=None):
+        if self.frames is None:
+            raise ValueError('No frames loaded, call loadFrames first')
+        records = self.loadRecords()
+        done = set(r['hash'] for r in records
+                   if r['frame_tuple'] == list(self.frameTuple) and os.path.isfile(r['file']))
+        tasks = []
+        for gid, params in enumerate(self.paramList):
+            if pD.param_hash(params) in done:
+                continue
+            tasks.append((gid, params, pD.descrSaveName(params, self.frameTuple)))
+        if not tasks:
+            return records
+
+        positions = np.array([at.positions for at in self.frames])
+        cells = np.array([at.cell[:] for at in self.frames])
+        pos_shm, pos_spec = _to_shared(positions)
+        cell_shm, cell_spec = _to_shared(cells)
+        del positions, cells
+        n_workers = min(n_workers if n_workers else os.cpu_count(), len(tasks))
+        try:
+            with pD.worker_threads(1), multiprocessing.Pool(n_workers, initializer=_init_sweep_worker,
+                                                            initargs=(pos_spec, cell_spec, self.frames[0].numbers,
+                                                                      self.frames[0].pbc, self.outDir)) as pool:
+                for rec in tqdm(pool.imap_unordered(_eval_point, tasks), total=len(tasks),
+                                desc='Parameter sweep'):
+                    rec['frame_tuple'] = list(self.frameTuple)
+                    records.append(rec)
+                    # records written as the points finish, to resume an interrupted sweep
+                    self.saveRecords(records)
+        finally:
+            for shm in [pos_shm, cell_shm]:
+                shm.close()
+                shm.unlink()
+        return records
+
+    def summary(self, key='t_eval'):
+        # grid points sorted by cost: (t_eval, dim, swept values, file)
+        records = sorted(self.loadRecords(), key=lambda r: r[key])
+        swept = [k for k in self.grid.keys()]
+        rows = []
+        for r in records:
+            values = []
+            for k in swept:
+                for kk in (k if isinstance(k, tuple) else (k,)):
+                    d = r['params']
+                    for p in kk.split('.'):
+                        d = d[p]
+                    values.append(d)
+            rows.append((r[key], r['dim'], values, r['file']))
+        return rows
@@ -7,9 +7,11 @@
 # ------------------------------------------------------------
 import numpy as np
 import math
-from ase.io import read, write
-from tqdm import tqdm
+import os
+import sys
 import anaAtoms as aA
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import trajIO as tIO
 
 # ------------------------------
 #
@@ -17,46 +19,48 @@ import anaAtoms as aA
 #
 # ------------------------------
 
-def heuristic_unwrapping(w,box):
-    # init the coordinates
-    u = np.empty((len(w),3))
-    # set the same starting point
+def unwrap_com(w, cells, method='hybrid'):
+    # w: wrapped coordinates [Nframe,Nmol,3], all molecules at once
+    # cells: per-frame cells [Nframe,3,3] (rows = lattice vectors, triclinic/NPT ok)
+    # image shifts are counted in fractional coordinates of each frame's cell
+    inv = np.linalg.inv(cells)
+    dw = np.diff(w, axis=0)
+    # image jumps between consecutive frames, in the cell of the new frame
+    jumps = np.floor(np.einsum('fmi,fij->fmj', dw, inv[1:]) + 0.5)
+    u = np.empty(np.shape(w))
     u[0] = w[0]
-    # computing the diff of the w traj
-    difw = np.diff(w, axis=0)
-    # ---
-    # Eq. 1 Heuristic method
-    for i,dw in enumerate(difw):
-        u[i+1] = w[i+1] - np.floor((w[i+1] - u[i])/box[i+1] + 0.5)*box[i+1]
+    if method == 'hybrid':
+        # Eq. 12: cumulative image count applied with the current cell
+        n = -np.cumsum(jumps, axis=0)
+        u[1:] = w[1:] + np.einsum('fmj,fjk->fmk', n, cells[1:])
+    elif method == 'displacement':
+        # Eq. 2: cumulative sum of the minimum image displacements
+        du = dw - np.einsum('fmj,fjk->fmk', jumps, cells[1:])
+        u[1:] = w[0] + np.cumsum(du, axis=0)
+    elif method == 'heuristic':
+        # Eq. 1: depends on the previous unwrapped frame, vectorized over molecules
+        for i in range(len(w)-1):
+            n = np.floor(np.dot(w[i+1]-u[i], inv[i+1]) + 0.5)
+            u[i+1] = w[i+1] - np.dot(n, cells[i+1])
+    else:
+        raise NameError('Unknown unwrapping method '+str(method))
     return u
+
+
+# single trajectory w [Nframe,3] with a cubic box [Nframe]
+def _cubic_cells(box):
+    return np.asarray(box, dtype=float).reshape(-1,1,1)*np.eye(3)
+
+def heuristic_unwrapping(w,box):
+    return unwrap_com(np.asarray(w)[:,None], _cubic_cells(box), 'heuristic')[:,0]
     
 
 def displacement_unwrapping(w,box):
-    # init the coordinates
-    u = np.empty((len(w),3))
-    # set the same starting point
-    u[0] = w[0]
-    # computing the diff of the w traj
-    difw = np.diff(w, axis=0)
-    # ---
-    # Eq 2. Displacemnet method
-    for i,dw in enumerate(difw):
-        u[i+1] = u[i] + (w[i+1] - w[i]) - np.floor((w[i+1] - w[i])/box[i+1] + 0.5)*box[i+1]
-    return u
+    return unwrap_com(np.asarray(w)[:,None], _cubic_cells(box), 'displacement')[:,0]
         
         
 def hybrid_unwrapping(w,box):
-    # init the coordinates
-    u = np.empty((len(w),3))
-    # set the same starting point
-    u[0] = w[0]
-    # computing the diff of the w traj
-    difw = np.diff(w, axis=0)
-    # ---
-    # Eq. 12 Hybrid mehtod
-    for i,dw in enumerate(difw):
-        u[i+1] = u[i]+(w[i+1]-w[i])-np.floor((w[i+1]-w[i])/box[i+1]+0.5)*box[i+1]-np.floor((w[i]-u[i])/box[i]+0.5)*(box[i+1]-box[i])
-    return u
+    return unwrap_com(np.asarray(w)[:,None], _cubic_cells(box), 'hybrid')[:,0]
 
 
 def get_MSD(xyz):
@@ -83,20 +87,24 @@ class trajectoryHandler:
 
 class TrajLoader(trajectoryHandler):
     def __init__(self, dirname, sysname, read_frame_tuple, 
-                 traj_species_dict, zshift_tuple, unwrap_dict):
+                 traj_species_dict, zshift_tuple, unwrap_dict,
+                 use_cache=True):
         super().__init__(dirname, sysname, read_frame_tuple)
 
         print('\n# --- Init the trajectory')
+        # binary cache if converted (trajIO.xyz2npy), else the indexed text file:
+        # every read goes straight to the frame
+        self.frameSource = tIO.open_traj(self.dirname+self.sysname, cache=use_cache)
         # just read the first frame to get the quantities
-        frameZero = read(self.dirname+self.sysname, index='0:1')
+        frameZero = [self.frameSource.readFrame(0)]
         self.RcutCorrectionDict = traj_species_dict['rcut_correction']
         self.UnwrapDict = unwrap_dict
         
-        # extraction of the CM position for each "molecule"
+        # molecular topology: computed once, reused for every frame
         print('\n# --- Extracting molecular information')
-        frameZeroMol = aA.extract_molecs(frameZero[:1], fct=self.RcutCorrectionDict)
-        self.atMolID = frameZero[0].arrays['molID']
-        self.molSym = frameZeroMol[0].arrays['molSym']
+        self.topology = aA.MolTopology(frameZero[0], fct=self.RcutCorrectionDict)
+        self.atMolID = self.topology.molID
+        self.molSym = self.topology.molSym
         self.Znumbers = frameZero[0].numbers
         # VVB thing
         self.__OldZnumbers = frameZero[0].numbers
@@ -120,17 +128,27 @@ class TrajLoader(trajectoryHandler):
                                 pass
                             
             
+    def __len__(self):
+        return len(self.frameSource)
+    
     def readFrame(self,n_frame,Zdiff=True):
-        ase_frame = read(self.dirname+self.sysname, index=f'{n_frame}:{n_frame+1}')[0]
+        ase_frame = self.frameSource.readFrame(n_frame)
         if Zdiff and hasattr(self, 'Znumbers'):
             ase_frame.numbers = self.Znumbers
         return ase_frame
     
     
-    def readTraj(self,Zdiff=True):
+    def readTraj(self,Zdiff=True,stream=False,batch=None):
         print(f"\n--- Loading traj {self.readFrames} ---\n")
+        if stream:
+            # COM unwrapping gets its own streaming pass over the raw frames
+            if self.UnwrapDict:
+                _ = self.trajUnwrapper(frame_tuple=self.readFrames, 
+                                       **self.UnwrapDict)
+            return self.iterTraj(batch=batch, Zdiff=Zdiff)
+        
         b,e,s = self.readFrames
-        ase_traj = read(self.dirname+self.sysname, index=f'{b}:{e}:{s}')
+        ase_traj = self.frameSource.readFrames(b, e, s)
         
         if self.UnwrapDict:
             _ = self.trajUnwrapper(frame_tuple=self.readFrames, 
@@ -143,29 +161,40 @@ class TrajLoader(trajectoryHandler):
         return ase_traj
     
     
+    def iterTraj(self,batch=None,Zdiff=True,frame_tuple=None):
+        # lazy reader: yields single frames, or lists of `batch` frames,
+        # so only one frame (batch) is held in memory at a time
+        b,e,s = frame_tuple if frame_tuple else self.readFrames
+        buffer = list()
+        for ase_frame in self.frameSource.iterFrames(b, e, s):
+            if Zdiff and hasattr(self, 'Znumbers'):
+                ase_frame.numbers = self.Znumbers
+            if not batch:
+                yield ase_frame
+                continue
+            buffer.append(ase_frame)
+            if len(buffer) == batch:
+                yield buffer
+                buffer = list()
+        if buffer:
+            yield buffer
+    
+    
     def trajUnwrapper(self,frame_tuple,species,method='hybrid',traj=None):
         print(f"\n--- Unwrapping the trajs {species} (COM) ---\n")
-        UNWRAP_FUNC = dict(
-            heuristic = heuristic_unwrapping,
-            displacement = displacement_unwrapping,
-            hybrid = hybrid_unwrapping,
-        )
-        
-        mol_traj = aA.extract_molecs_molID(traj, molID=self.atMolID, fct=self.RcutCorrectionDict)
+        # no traj given: COMs are extracted while streaming the frames
+        if traj is None:
+            traj = self.iterTraj(Zdiff=False, frame_tuple=frame_tuple)
+        mol_com, mol_cells, _ = aA.extract_molecs_com(traj, molID=self.atMolID, 
+                                                      masses=self.topology.masses, molSym=self.molSym)
 
-        # assuming cubic
-        box_val = [atom.cell[0][0] for atom in mol_traj]
-        # ref species for the unwrap
-        ref_spec_idx = [[idx for idx,spec in enumerate(self.molSym) if spec == MOL] for MOL in species]
+        # all molecules at once, full per-frame cells
+        unwrapped = unwrap_com(mol_com, mol_cells, method)
         
+        # one array per species [Nmol,Nframe,3]
         unwrapped_coords = dict()
-        for s,idxmask in enumerate(ref_spec_idx):
-            
-            unwrapped_coords[species[s]] = list()
-            for idx in tqdm(idxmask, desc=f'Unwrapping: {species[s]}'):
-                
-                w = np.array([ts[idx].position for ts in mol_traj])
-                unwrapped_coords[species[s]].append(UNWRAP_FUNC[method](w,box_val))
+        for MOL in species:
+            unwrapped_coords[MOL] = np.transpose(unwrapped[:, self.molSym == MOL], (1,0,2))
         
         # saving the trajs
         interval_str = '-'.join(map(str,frame_tuple))
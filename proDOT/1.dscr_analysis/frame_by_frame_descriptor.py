@@ -9,9 +9,13 @@
 import numpy as np
 import argparse
 import toml
-from ase.io import read, write
+import os
+import sys
 from quippy import descriptors
 from tqdm import tqdm
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
+import trajIO as tIO
+from paramHash import param_hash
 
 # ------------------------------------------------------------
 # Functions
@@ -43,8 +47,10 @@ def ds_frame_by_frame(sys_name, ds_obj,
     range_ = np.arange(1,f_range+1,every)
     if debug:
         print(len(range_), range_)
+    # binary cache or indexed text file: no re-scanning per frame
+    frames = tIO.open_traj(sys_name, fmt='xyz')
     for f in tqdm(range_):
-        snap_tmp = read(sys_name, index=str(f-1)+':'+str(f), format='xyz')
+        snap_tmp = [frames.readFrame(f-1)]
         ps_tmp = ds_obj.calc_descriptor(snap_tmp)
         ps_list.append(ps_tmp[0])
     return np.concatenate(ps_list)
@@ -87,7 +93,8 @@ def main(config):
     output_name = config.descriptor['type']+'_n_Z'+\
                   str(config.descriptor['n_Z'])+\
                   '_Z'+config.descriptor['Z'][1:-1]+\
-                  '_Nframe'+str(n_frame)+'every'+str(skip)
+                  '_Nframe'+str(n_frame)+'every'+str(skip)+\
+                  '_'+param_hash(dscr_dict)[:8]
     
     np.save(output_name, ds_vec)
 
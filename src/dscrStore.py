@@ -0,0 +1,257 @@
+import numpy as np
+import os
+import json
+import zlib
+import argparse
+from functools import lru_cache
+
+# --- Compact descriptor storage
+# <name>.dstore/
+#   meta.json   shape, stored dtype, rows per chunk, compression settings
+#   index.npy   byte offsets of the compressed chunks in data.bin (Nchunk+1)
+#   data.bin    zlib compressed chunks of rows (last axis = descriptor vector)
+# chunks are byte shuffled before compression (the i-th bytes of all the
+# values stored together), which compresses the exponents of float data well
+
+def store_name(name):
+    return name if name.endswith('.dstore') else name + '.dstore'
+
+
+def _shuffle(raw, itemsize):
+    return np.frombuffer(raw, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _unshuffle(raw, itemsize):
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def _index(key, n):
+    if isinstance(key, slice):
+        return np.arange(*key.indices(n))
+    idx = np.asarray(key)
+    return np.where(idx < 0, idx+n, idx)
+
+
+class DescrWriter:
+    """
+    Appends descriptor blocks [n, ..., Ndescr] (e.g. ChunkEval chunks or
+    frame by frame vectors) to a compact store, one compressed chunk
+    of chunk_rows rows at a time.
+    :param name: output name, .dstore appended if missing
+    :param dtype: stored dtype (float32 or float16, float64 lossless)
+    :param chunk_rows: rows (descriptor vectors) per compressed chunk
+    :param level: zlib compression level
+    :param shuffle: byte shuffle the chunks before compression
+    """
+    def __init__(self, name, dtype='float32', chunk_rows=4096, level=3, shuffle=True):
+        self.path = store_name(name)
+        os.makedirs(self.path, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        self.chunkRows = chunk_rows
+        self.level = level
+        self.shuffle = shuffle
+        self.inner = None
+        self.nblock = 0
+        self.nrows = 0
+        self.offsets = [0]
+        self.maxErr = 0.0
+        self.buf = []
+        self.nbuf = 0
+        self.f = open(os.path.join(self.path, 'data.bin'), 'wb')
+
+    def append(self, block):
+        block = np.asarray(block)
+        if self.inner is None:
+            self.inner = list(block.shape[1:])
+        elif list(block.shape[1:]) != self.inner:
+            raise ValueError(f'Block shape {block.shape[1:]} does not match {tuple(self.inner)}')
+        self.nblock += block.shape[0]
+        rows = block.reshape(-1, block.shape[-1])
+        self.buf.append(rows)
+        self.nbuf += len(rows)
+        while self.nbuf >= self.chunkRows:
+            rows = np.concatenate(self.buf)
+            self._write(rows[:self.chunkRows])
+            self.buf = [rows[self.chunkRows:]]
+            self.nbuf = len(self.buf[0])
+
+    def _write(self, rows):
+        stored = rows.astype(self.dtype)
+        if len(rows):
+            self.maxErr = max(self.maxErr, float(np.max(np.abs(stored.astype(np.float64)-rows))))
+        raw = stored.tobytes()
+        if self.shuffle:
+            raw = _shuffle(raw, self.dtype.itemsize)
+        self.f.write(zlib.compress(raw, self.level))
+        self.offsets.append(self.f.tell())
+        self.nrows += len(rows)
+
+    def close(self):
+        if self.nbuf:
+            self._write(np.concatenate(self.buf))
+        self.buf = []
+        self.nbuf = 0
+        self.f.close()
+        np.save(os.path.join(self.path, 'index.npy'), np.array(self.offsets, dtype=np.int64))
+        meta = dict(shape=[self.nblock]+(self.inner or [0]), nrows=self.nrows,
+                    ndescr=(self.inner or [0])[-1], dtype=self.dtype.name,
+                    chunk_rows=self.chunkRows, level=self.level, shuffle=self.shuffle,
+                    max_abs_err=self.maxErr)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return DescrStore(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.f.closed:
+            self.close()
+
+
+class DescrStore:
+    """
+    Reader of a compact store, decompressed chunk by chunk on access with
+    the last cache_chunks chunks kept in memory. Indexed like the stored
+    array (e.g. [Nframe, Ncenters, Ndescr]):
+    store[f], store[b:e:s], store[index_array] -> frames in the stored dtype
+    store.rows[...] indexes the rows (descriptor vectors) of the store seen
+    as [nrows, Ndescr]
+    """
+    def __init__(self, name, cache_chunks=16):
+        self.path = store_name(name)
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(self.path, 'index.npy'))
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.shape = tuple(self.meta['shape'])
+        self.nrows = self.meta['nrows']
+        self.ndescr = self.meta['ndescr']
+        self.chunkRows = self.meta['chunk_rows']
+        # rows per item of the first axis
+        self.itemRows = int(np.prod(self.shape[1:-1]))
+        self.rows = _Rows(self)
+        self._chunk = lru_cache(maxsize=cache_chunks)(self._readChunk)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _readChunk(self, c):
+        with open(os.path.join(self.path, 'data.bin'), 'rb') as f:
+            f.seek(self.offsets[c])
+            raw = zlib.decompress(f.read(self.offsets[c+1]-self.offsets[c]))
+        if self.meta['shuffle']:
+            raw = _unshuffle(raw, self.dtype.itemsize)
+        return np.frombuffer(raw, dtype=self.dtype).reshape(-1, self.ndescr)
+
+    def _readRows(self, idx):
+        out = np.empty((len(idx), self.ndescr), dtype=self.dtype)
+        chunks = idx // self.chunkRows
+        for c in np.unique(chunks):
+            sel = chunks == c
+            out[sel] = self._chunk(c)[idx[sel] % self.chunkRows]
+        return out
+
+    def __getitem__(self, key):
+        N = self.shape[0]
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += N
+            if not 0 <= key < N:
+                raise IndexError(f'Index {key} out of range ({N} items)')
+            idx = np.arange(key*self.itemRows, (key+1)*self.itemRows)
+            return self._readRows(idx).reshape(self.shape[1:])
+        items = _index(key, N)
+        idx = (items[:,None]*self.itemRows+np.arange(self.itemRows)).ravel()
+        return self._readRows(idx).reshape((len(items),)+self.shape[1:])
+
+    def iterChunks(self, dtype=None):
+        for c in range(len(self.offsets)-1):
+            rows = self._readChunk(c)
+            yield rows if dtype is None else rows.astype(dtype)
+
+    def read(self, dtype=None, flat=False):
+        """
+        Whole store in memory, filled chunk by chunk (no float64 copy).
+        :param dtype: output dtype, default the stored one (float16 read as float32)
+        :param flat: [nrows, Ndescr] instead of the original shape
+        """
+        if dtype is None:
+            dtype = np.float32 if self.dtype == np.float16 else self.dtype
+        out = np.empty((self.nrows, self.ndescr), dtype=dtype)
+        for c, rows in enumerate(self.iterChunks()):
+            out[c*self.chunkRows:c*self.chunkRows+len(rows)] = rows
+        return out if flat else out.reshape(self.shape)
+
+    def disk_size(self):
+        return int(self.offsets[-1])
+
+
+class _Rows:
+    # store.rows[...]: rows of the store seen as [nrows, Ndescr]
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.nrows
+
+    def __getitem__(self, key):
+        n = self.store.nrows
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += n
+            if not 0 <= key < n:
+                raise IndexError(f'Row {key} out of range ({n} rows)')
+            return self.store._chunk(key // self.store.chunkRows)[key % self.store.chunkRows].copy()
+        return self.store._readRows(_index(key, n))
+
+
+def save_descr(name, X, dtype='float32', chunk_rows=4096, level=3, shuffle=True):
+    """
+    Writes a descriptor array (or memmap, read block by block) into a compact store.
+    :return: DescrStore of the written store
+    """
+    with DescrWriter(name, dtype, chunk_rows, level, shuffle) as w:
+        step = max(1, chunk_rows // max(1, int(np.prod(X.shape[1:-1]))))
+        for b in range(0, X.shape[0], step):
+            w.append(np.asarray(X[b:b+step]))
+        return w.close()
+
+
+def open_descr(name):
+    """
+    Descriptor data of name: a DescrStore for .dstore directories,
+    a read-only memmap for .npy files.
+    """
+    if os.path.isdir(store_name(name)):
+        return DescrStore(name)
+    return np.load(name, mmap_mode='r')
+
+
+def load_descr(name, dtype=None, flat=False):
+    """
+    Descriptor array in memory from a .dstore or a .npy file.
+    """
+    data = open_descr(name)
+    if isinstance(data, DescrStore):
+        return data.read(dtype, flat)
+    data = np.asarray(data, dtype=dtype)
+    return data.reshape(-1, data.shape[-1]) if flat else data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("npy", type=str, help=".npy descriptor file")
+    parser.add_argument("-o", dest="name", type=str, default=None,
+                        help="output name (default: npy name with .dstore)")
+    parser.add_argument("--dtype", dest="dtype", type=str, default='float32',
+                        help="stored dtype (float32/float16/float64)")
+    parser.add_argument("--chunk", dest="chunk_rows", type=int, default=4096,
+                        help="rows per compressed chunk")
+    parser.add_argument("--level", dest="level", type=int, default=3,
+                        help="zlib compression level")
+    args = parser.parse_args()
+    name = args.name if args.name else args.npy[:-4] if args.npy.endswith('.npy') else args.npy
+    store = save_descr(name, np.load(args.npy, mmap_mode='r'), args.dtype, args.chunk_rows, args.level)
+    print(f"{store.path}: {store.disk_size()/2**20:.1f} MB "
+          f"({os.path.getsize(args.npy)/2**20:.1f} MB npy), max abs err {store.meta['max_abs_err']:.2e}")
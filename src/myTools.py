@@ -2,7 +2,10 @@ import numpy as np
 import os
 import re
 import ase
-from ase.io import read
+try:
+    from . import trajIO as tIO
+except ImportError:
+    import trajIO as tIO
 
 # --- Files
 
@@ -30,17 +33,20 @@ def get_filesEW(folder, extension, verbose=True):
 
 # simple ase reader for the traj file
 def ase_xyz_reader(traj_file,
-                   index_slice=slice(None, None, None)):
+                   index_slice=slice(None, None, None),
+                   use_cache=True):
     """
     Simple translator from a XYZ traj file
     to a ASE atoms traj file.
     :param traj_file:
     :param index_slice:
+    :param use_cache: read the binary cache (trajIO.xyz2npy) if up to date
     :return: ASEatoms traj objectv
     """
     print(f"Done with ase version {ase.__version__}")
     print(f"--- Reading {traj_file}")
-    return read(traj_file, index=index_slice, format='xyz')
+    # frames are read through the binary cache or the byte-offset index
+    return tIO.open_traj(traj_file, fmt='xyz', cache=use_cache)[index_slice]
 
 
 # adding pbc to the xyz traj read by ase
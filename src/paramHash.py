@@ -0,0 +1,16 @@
+import json
+import hashlib
+
+# --- Descriptor parameter hash
+# shared by every tool that names descriptor outputs (pipeDescriptor.descrSaveName,
+# the frame by frame scripts, pipeSweep) so that the same parameters give the same suffix
+
+def param_hash(param_dict):
+    """
+    Canonical sha1 of a descriptor parameter dict (nested dicts included).
+    :param param_dict: descriptor parameters (toml [descriptor] table or pipe dict)
+    :return: hex digest; central_index is left out, get_turbo_parameters rewrites it in place
+    """
+    params = {k: v for k, v in param_dict.items() if k != 'central_index'}
+    canon = json.dumps(params, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha1(canon.encode()).hexdigest()
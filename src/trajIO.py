@@ -0,0 +1,294 @@
+import numpy as np
+import os
+import io
+import json
+import mmap
+import argparse
+from ase import Atoms
+from ase.io import read
+
+# --- Frame index
+
+# sidecar file holding the frame byte offsets of a trajectory
+def index_name(traj_file):
+    return traj_file + '.fidx.npz'
+
+
+# byte position right after the k-th newline found from `start`
+def _skip_lines(buf, start, k, guess=1 << 20):
+    size = len(buf)
+    pos = start
+    while pos < size:
+        stop = min(pos + guess, size)
+        nl = np.flatnonzero(buf[pos:stop] == 10)
+        if len(nl) >= k:
+            return pos + nl[k-1] + 1
+        k -= len(nl)
+        pos = stop
+        guess *= 2
+    return size
+
+
+def build_frame_index(traj_file):
+    """
+    One pass over a (ext)xyz trajectory collecting the byte
+    offset and the number of atoms of every frame.
+    :param traj_file: xyz trajectory file
+    :return: offsets (Nframe+1, last one is EOF), natoms (Nframe)
+    """
+    offsets = list()
+    natoms = list()
+    if os.path.getsize(traj_file) == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    with open(traj_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            size = len(buf)
+            hdr = 0
+            guess = 1 << 20
+            while hdr < size:
+                end = mm.find(b'\n', hdr)
+                line = mm[hdr:end if end != -1 else size]
+                if not line.strip():
+                    break
+                n = int(line)
+                offsets.append(hdr)
+                natoms.append(n)
+                # frame = natoms line + comment line + n atom lines
+                nxt = _skip_lines(buf, hdr, n+2, guess)
+                guess = max(nxt - hdr, 1)
+                hdr = nxt
+            offsets.append(hdr)
+            del buf
+    return np.array(offsets, dtype=np.int64), np.array(natoms, dtype=np.int64)
+
+
+def load_frame_index(traj_file, rebuild=False, save=True):
+    """
+    Loads the sidecar frame index of traj_file, (re)building it
+    whenever it is missing or stale (file size or mtime changed).
+    :param traj_file: xyz trajectory file
+    :param rebuild: force the index to be rebuilt
+    :param save: write the (re)built index next to the trajectory
+    :return: offsets (Nframe+1), natoms (Nframe)
+    """
+    stat = os.stat(traj_file)
+    idx_file = index_name(traj_file)
+    if not rebuild and os.path.isfile(idx_file):
+        idx = np.load(idx_file)
+        if int(idx['size']) == stat.st_size and float(idx['mtime']) == stat.st_mtime:
+            return idx['offsets'], idx['natoms']
+    print(f"--- Indexing frames of {traj_file}")
+    offsets, natoms = build_frame_index(traj_file)
+    if save:
+        try:
+            with open(idx_file, 'wb') as f:
+                np.savez(f, offsets=offsets, natoms=natoms,
+                         size=stat.st_size, mtime=stat.st_mtime)
+        except OSError as err:
+            print(f"Frame index not saved ({err})")
+    return offsets, natoms
+
+
+class FrameIndex:
+    """
+    Random access reader for (ext)xyz trajectories: every frame
+    is read by seeking straight to its byte offset.
+    """
+    def __init__(self, traj_file, fmt='extxyz', rebuild=False):
+        self.trajFile = traj_file
+        self.fmt = fmt
+        self.offsets, self.natoms = load_frame_index(traj_file, rebuild=rebuild)
+
+    def __len__(self):
+        return len(self.natoms)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.readFrames(*key.indices(len(self)))
+        return self.readFrame(key)
+
+    def _parse(self, raw):
+        return read(io.StringIO(raw.decode()), index=0, format=self.fmt)
+
+    def readFrame(self, n_frame):
+        if n_frame < 0:
+            n_frame += len(self)
+        if not 0 <= n_frame < len(self):
+            raise IndexError(f'Frame {n_frame} out of range ({len(self)} frames)')
+        with open(self.trajFile, 'rb') as f:
+            f.seek(self.offsets[n_frame])
+            raw = f.read(self.offsets[n_frame+1] - self.offsets[n_frame])
+        return self._parse(raw)
+
+    def iterFrames(self, b=0, e=None, s=1):
+        frames = range(*slice(b, e, s).indices(len(self)))
+        with open(self.trajFile, 'rb') as f:
+            for n in frames:
+                f.seek(self.offsets[n])
+                yield self._parse(f.read(self.offsets[n+1] - self.offsets[n]))
+
+    def readFrames(self, b=0, e=None, s=1):
+        return list(self.iterFrames(b, e, s))
+
+
+# --- Binary (memory-mapped) trajectory cache
+
+# directory holding the .npy arrays of a converted trajectory
+def cache_name(traj_file):
+    return traj_file + '.npycache'
+
+
+def _source_stamp(traj_file):
+    stat = os.stat(traj_file)
+    return dict(source=os.path.abspath(traj_file), size=stat.st_size, mtime=stat.st_mtime)
+
+
+def xyz2npy(traj_file, cache_dir=None, dtype='float64',
+            info_keys=(), arrays_keys=('molID',), molID=None,
+            fmt='extxyz', prog=True):
+    """
+    One-time conversion of a text trajectory into memory-mapped
+    .npy arrays: positions [Nframe,Nat,3], cells [Nframe,3,3],
+    numbers [Nat], pbc, per-atom arrays and per-frame info keys.
+    The number and the order of the atoms must not change.
+    :param traj_file: xyz trajectory file
+    :param cache_dir: output directory, default traj_file.npycache
+    :param dtype: positions dtype (float32 or float64)
+    :param info_keys: per-frame atoms.info keys to store
+    :param arrays_keys: per-atom atoms.arrays keys to store (from frame 0)
+    :param molID: molID array to store when not in the frames
+    :param fmt: ase format of the text trajectory
+    :param prog: print the progress
+    :return: TrajCache of the converted trajectory
+    """
+    if cache_dir is None:
+        cache_dir = cache_name(traj_file)
+    frames = FrameIndex(traj_file, fmt=fmt)
+    Nframe = len(frames)
+    if Nframe == 0 or np.any(frames.natoms != frames.natoms[0]):
+        raise ValueError(f'{traj_file}: the cache needs a constant number of atoms')
+    Nat = int(frames.natoms[0])
+    os.makedirs(cache_dir, exist_ok=True)
+
+    positions = np.lib.format.open_memmap(os.path.join(cache_dir, 'positions.npy'),
+                                          mode='w+', dtype=dtype, shape=(Nframe, Nat, 3))
+    cells = np.lib.format.open_memmap(os.path.join(cache_dir, 'cells.npy'),
+                                      mode='w+', dtype=np.float64, shape=(Nframe, 3, 3))
+    info = {key: list() for key in info_keys}
+    for n, at in enumerate(frames.iterFrames()):
+        if n == 0:
+            numbers = at.numbers.copy()
+            np.save(os.path.join(cache_dir, 'numbers.npy'), numbers)
+            np.save(os.path.join(cache_dir, 'pbc.npy'), at.pbc)
+            stored_arrays = [key for key in arrays_keys if key in at.arrays]
+            for key in stored_arrays:
+                np.save(os.path.join(cache_dir, 'arrays_'+key+'.npy'), at.arrays[key])
+        elif np.any(at.numbers != numbers):
+            raise ValueError(f'{traj_file}: atomic numbers change at frame {n}')
+        positions[n] = at.positions
+        cells[n] = at.cell[:]
+        for key in info_keys:
+            info[key].append(at.info[key])
+        if prog and (n+1) % 1000 == 0:
+            print(f"{n+1}/{Nframe}")
+    positions.flush()
+    cells.flush()
+    del positions, cells
+    if molID is not None and 'molID' not in stored_arrays:
+        np.save(os.path.join(cache_dir, 'arrays_molID.npy'), np.asarray(molID))
+        stored_arrays.append('molID')
+    for key, value in info.items():
+        np.save(os.path.join(cache_dir, 'info_'+key+'.npy'), np.array(value))
+
+    meta = _source_stamp(traj_file)
+    meta.update(nframe=Nframe, natoms=Nat, dtype=np.dtype(dtype).name,
+                info_keys=list(info_keys), arrays_keys=stored_arrays)
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    return TrajCache(cache_dir)
+
+
+def valid_cache(traj_file, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = cache_name(traj_file)
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    stamp = _source_stamp(traj_file)
+    return meta['size'] == stamp['size'] and meta['mtime'] == stamp['mtime']
+
+
+class TrajCache:
+    """
+    Reader of a trajectory converted by xyz2npy. Arrays are memory
+    mapped: opening is instantaneous and slicing the positions
+    (cache.positions[b:e:s]) does not copy. Same frame interface
+    as FrameIndex.
+    """
+    def __init__(self, cache_dir):
+        self.cacheDir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.positions = np.load(os.path.join(cache_dir, 'positions.npy'), mmap_mode='r')
+        self.cells = np.load(os.path.join(cache_dir, 'cells.npy'), mmap_mode='r')
+        self.numbers = np.load(os.path.join(cache_dir, 'numbers.npy'))
+        self.pbc = np.load(os.path.join(cache_dir, 'pbc.npy'))
+        self.arrays = {key: np.load(os.path.join(cache_dir, 'arrays_'+key+'.npy'))
+                       for key in self.meta['arrays_keys']}
+        self.info = {key: np.load(os.path.join(cache_dir, 'info_'+key+'.npy'), mmap_mode='r')
+                     for key in self.meta['info_keys']}
+        self.natoms = np.full(len(self), len(self.numbers), dtype=np.int64)
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.readFrames(*key.indices(len(self)))
+        return self.readFrame(key)
+
+    def readFrame(self, n_frame):
+        at = Atoms(numbers=self.numbers,
+                   positions=np.asarray(self.positions[n_frame], dtype=np.float64),
+                   cell=np.asarray(self.cells[n_frame]), pbc=self.pbc)
+        for key, value in self.arrays.items():
+            at.arrays[key] = value.copy()
+        for key, value in self.info.items():
+            at.info[key] = value[n_frame]
+        return at
+
+    def iterFrames(self, b=0, e=None, s=1):
+        for n in range(*slice(b, e, s).indices(len(self))):
+            yield self.readFrame(n)
+
+    def readFrames(self, b=0, e=None, s=1):
+        return list(self.iterFrames(b, e, s))
+
+
+def open_traj(traj_file, fmt='extxyz', cache=True):
+    """
+    Frame reader for traj_file: the binary cache when it exists
+    and is up to date, the indexed text file otherwise.
+    """
+    if cache and valid_cache(traj_file):
+        return TrajCache(cache_name(traj_file))
+    return FrameIndex(traj_file, fmt=fmt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("traj", type=str, help="xyz trajectory file")
+    parser.add_argument("-o", dest="cache_dir", type=str, default=None,
+                        help="cache directory")
+    parser.add_argument("--dtype", dest="dtype", type=str, default='float64',
+                        help="positions dtype (float32/float64)")
+    parser.add_argument("--info", dest="info_keys", type=str, nargs='*', default=[],
+                        help="info keys to store")
+    parser.add_argument("--format", dest="fmt", type=str, default='extxyz',
+                        help="ase format of the trajectory")
+    args = parser.parse_args()
+    xyz2npy(args.traj, cache_dir=args.cache_dir, dtype=args.dtype,
+            info_keys=args.info_keys, fmt=args.fmt)